@@ -0,0 +1,329 @@
+#!/usr/bin/python
+# Benchmarks indexing and searching.
+#
+# The benchmark has three parts:
+# - generate_corpus writes a synthetic legal corpus, documents in the XML shape that
+#   parse_xml in index.py reads, from a fixed seed;
+# - run_indexing runs index.py on a corpus and measures its throughput and the size
+#   of the index;
+# - run_queries runs a mix of queries drawn from the corpus (see generate_queries)
+#   through search.py in server mode, and measures the latency of every query.
+# The results are written as JSON, and can be compared against the results of an
+# earlier run (the baseline).
+#
+# The corpus and the queries only depend on the seed, so two runs with the same seed
+# index and search exactly the same documents and queries.
+
+import getopt
+import json
+import math
+import os
+import pickle
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import time
+from xml.sax.saxutils import escape
+from utility import *
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+default_seed = 2017
+# Words of the synthetic documents. Words earlier in the list are more frequent.
+legal_words = ("court appeal judgment plaintiff defendant contract damages claim evidence trial "
+    "order liability breach duty care negligence statute tribunal witness ruling injunction relief "
+    "reasonable respondent appellant agreement party parties property land lease tenant landlord "
+    "company director shareholder bank loan payment debt interest costs judge decision section act "
+    "law rights obligation notice application hearing counsel arbitration award sale goods buyer "
+    "seller delivery price loss injury accident employer employee dismissal wages insurance policy "
+    "premium fraud misrepresentation estoppel trust beneficiary trustee estate will probate divorce "
+    "custody maintenance crime offence sentence conviction prosecution accused guilty murder theft "
+    "assault charge bail jurisdiction constitution citizen immigration tax revenue assessment "
+    "commissioner copyright patent trademark infringement licence defamation libel slander privacy "
+    "indemnity redress compensation undertaking declaration remedy specific performance rescission "
+    "termination repudiation frustration consideration offer acceptance warranty condition").split()
+# Words that hold documents together, as in real text. Most of them are stopwords.
+filler_words = "the of and to in a is was that for by with as on it be which are this from at not".split()
+courts = ["SGHC", "SGCA", "SGDC", "SGMC", "SG Family Court", "UKHL", "UKSC", "EWCA Civ", "EWHC",
+    "NSWCA", "HCA", "FCA", "NZCA", "HKCFA", None]
+# Phrases planted in documents, so phrase queries have matches beyond chance.
+planted_phrases = ["duty of care", "breach of contract", "reasonable care", "specific performance",
+    "court of appeal", "sale of goods", "misrepresentation and fraud", "dismissal of the appeal"]
+
+# Writes document_count synthetic documents into directory, named by their doc IDs.
+# A document has between 1/4 and 7/4 times document_words words, drawn from
+# legal_words with Zipf-like frequencies and mixed with filler words and punctuation.
+# Returns the doc IDs of the documents.
+def generate_corpus(directory, document_count, seed = default_seed, document_words = 400):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    weights = [1 / (rank + 1) for rank in range(len(legal_words))]
+    doc_ids = sorted(rng.sample(range(100000, 100000 + 20 * document_count), document_count))
+    for doc_id in doc_ids:
+        length = rng.randint(document_words // 4, document_words * 7 // 4)
+        words = []
+        for word in rng.choices(legal_words, weights, k=length):
+            if rng.random() < 0.4:
+                words.append(rng.choice(filler_words))
+            words.append(word + (rng.choice(".,;") if rng.random() < 0.08 else empty_string))
+        for phrase in rng.sample(planted_phrases, rng.randint(0, 3)):
+            i = rng.randrange(len(words))
+            words[i:i] = phrase.split()
+        content = " ".join(words).capitalize() + "."
+        court = rng.choice(courts)
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>', "<doc>",
+            '<str name="document_id">' + str(doc_id) + '</str>',
+            '<str name="title">Case ' + str(doc_id) + '</str>',
+            '<str name="content">' + escape(content) + '</str>']
+        if court is None:
+            parts.append('<arr name="jurisdiction"><str>Singapore</str></arr>')
+        else:
+            parts.append('<str name="court">' + escape(court) + '</str>')
+        if rng.random() < 0.2:
+            parts.append('<arr name="tag"><str>' + escape(rng.choice(legal_words)) + '</str></arr>')
+        parts.append("</doc>")
+        with open(os.path.join(directory, str(doc_id) + xml), mode="w", encoding="utf8") as xf:
+            xf.write("\n".join(parts) + "\n")
+    return doc_ids
+
+# Returns the sorted doc IDs of the documents in directory.
+def get_collection(directory):
+    return sorted(int(filename[:-len(xml)]) for filename in os.listdir(directory) if filename.endswith(xml))
+
+# Builds the index of the documents in directory into work_directory with index.py,
+# given a list of extra index.py options.
+# Returns the number of documents, the seconds it took (including the start of the
+# interpreter), the documents per second and the size of every file of the index.
+def run_indexing(directory, work_directory, index_options = []):
+    os.makedirs(work_directory, exist_ok=True)
+    (dictionary_file, postings_file) = get_index_files(work_directory)
+    document_count = len(get_collection(directory))
+    command = [sys.executable, os.path.join(here, "index.py"), "-i", os.path.join(directory, empty_string),
+        "-d", dictionary_file, "-p", postings_file] + index_options
+    start = time.perf_counter()
+    # index.py writes its run files into the current directory.
+    subprocess.run(command, cwd=work_directory, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    index_files = {filename: os.path.getsize(os.path.join(work_directory, filename))
+        for filename in sorted(os.listdir(work_directory))
+        if filename.startswith(("dictionary", "postings"))}
+    return {"documents": document_count, "seconds": seconds, "documents_per_second": document_count / seconds,
+        "index_bytes": sum(index_files.values()), "index_files": index_files}
+
+# Returns the dictionary file and the postings file of the index in work_directory.
+def get_index_files(work_directory):
+    work_directory = os.path.abspath(work_directory)
+    return os.path.join(work_directory, "dictionary"), os.path.join(work_directory, "postings")
+
+# Draws query_count queries from the documents in directory, about a third of each kind:
+# - phrase: one phrase of two or three consecutive words of a document;
+# - and: two or three words or phrases of the same document, connected by AND;
+# - expansion: a single word with many synonyms, which gives long expansion rounds.
+# Returns a list of (kind, query line) tuples.
+def generate_queries(directory, query_count, seed = default_seed, tokenizer_name = NLTK_TOKENIZER):
+    from index import parse_xml
+    rng = random.Random(seed)
+    set_tokenizer(tokenizer_name)
+    collection = get_collection(directory)
+    documents = []
+    for doc_id in rng.sample(collection, min(len(collection), max(query_count, 20))):
+        (content, court, tag) = parse_xml(os.path.join(directory, empty_string), doc_id)
+        words = [word.casefold() for word in tokenize(content) if word.isalpha()]
+        if len(words) >= 3:
+            documents.append(words)
+
+    kinds = ["phrase", "and", "expansion"]
+    expansion_words = get_expansion_words(documents, rng)
+    queries = []
+    for i in range(query_count):
+        kind = kinds[i % len(kinds)]
+        words = rng.choice(documents)
+        if kind == "phrase":
+            line = '"' + get_phrase(words, rng, rng.randint(2, 3)) + '"'
+        elif kind == "and":
+            phrases = [get_phrase(words, rng, rng.randint(1, 2)) for j in range(rng.randint(2, 3))]
+            line = " AND ".join('"' + phrase + '"' for phrase in phrases)
+        else:
+            line = '"' + rng.choice(expansion_words) + '"'
+        queries.append((kind, line))
+    return queries
+
+# Returns count consecutive words of a document that start with a word that is not a
+# stopword, so the phrase is not dropped by the query parser.
+def get_phrase(words, rng, count):
+    for attempt in range(100):
+        start = rng.randrange(len(words) - count + 1)
+        if not check_stopwords(words[start]):
+            break
+    return " ".join(words[start:start + count])
+
+# Returns the words of the documents with the most WordNet synonyms.
+def get_expansion_words(documents, rng):
+    from synonyms import get_wordnet_synonyms
+    words = sorted(set(word for words in documents for word in words if not check_stopwords(word)))
+    synonym_counts = dict()
+    for word in rng.sample(words, min(len(words), 200)):
+        (word_synonyms, phrase_synonyms) = get_wordnet_synonyms(word)
+        synonym_counts[word] = len(word_synonyms) + len(phrase_synonyms)
+    return sorted(synonym_counts, key=lambda word: (-synonym_counts[word], word))[:20]
+
+# Runs the queries through search.py in server mode (-s -) on the index in
+# work_directory, given a list of extra search.py options. Every query is run once to
+# warm up, then repeats times while the time from sending it to reading its results
+# is measured.
+# Returns the latency statistics of all queries and of every kind of query.
+def run_queries(work_directory, queries, repeats = 3, search_options = []):
+    (dictionary_file, postings_file) = get_index_files(work_directory)
+    command = [sys.executable, os.path.join(here, "search.py"), "-d", dictionary_file, "-p", postings_file,
+        "-s", "-"] + search_options
+    server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding="utf8")
+    latencies = {kind: [] for (kind, line) in queries}
+    for (kind, line) in queries:
+        answer_query(server, line)
+    for repeat in range(repeats):
+        for (kind, line) in queries:
+            start = time.perf_counter()
+            answer_query(server, line)
+            latencies[kind].append(time.perf_counter() - start)
+    server.stdin.close()
+    server.wait()
+
+    results = {"all": get_latency_stats([latency for kind in latencies for latency in latencies[kind]])}
+    for kind in sorted(latencies):
+        results[kind] = get_latency_stats(latencies[kind])
+    return results
+
+# Sends a query to the search server and returns the line of results.
+def answer_query(server, line):
+    server.stdin.write(line + "\n")
+    server.stdin.flush()
+    return server.stdout.readline()
+
+# Returns the count, mean, p50, p95 and p99 of latencies in milliseconds, and the
+# number of queries per second.
+def get_latency_stats(latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {"count": len(latencies), "mean_ms": 1000 * total / len(latencies),
+        "p50_ms": 1000 * get_percentile(latencies, 50), "p95_ms": 1000 * get_percentile(latencies, 95),
+        "p99_ms": 1000 * get_percentile(latencies, 99), "queries_per_second": len(latencies) / total}
+
+# Returns the percentile of sorted values, by the nearest-rank method.
+def get_percentile(values, percentile):
+    return values[max(math.ceil(percentile / 100 * len(values)) - 1, 0)]
+
+# Runs the whole benchmark on the corpus in directory, with its index in work_directory.
+# Returns the results.
+def run_benchmark(directory, work_directory, query_count, repeats, seed, index_options, search_options):
+    results = {"settings": {"corpus": os.path.abspath(directory), "queries": query_count, "repeats": repeats,
+        "seed": seed, "index_options": index_options, "search_options": search_options,
+        "python": platform.python_version(), "machine": platform.machine()}}
+    print("indexing " + directory + "...")
+    results["indexing"] = run_indexing(directory, work_directory, index_options)
+    # Queries are drawn from the words of the documents, split as the index splits them.
+    with open(get_index_files(work_directory)[0], mode="rb") as df:
+        tokenizer_name = pickle.load(df)[0].get(TOKENIZER, NLTK_TOKENIZER)
+    queries = generate_queries(directory, query_count, seed, tokenizer_name)
+    print("running " + str(len(queries)) + " queries " + str(repeats) + " times...")
+    results["queries"] = run_queries(work_directory, queries, repeats, search_options)
+    return results
+
+# Prints the results, and how every number changed since the baseline if there is one.
+def print_results(results, baseline = None):
+    for section in ("indexing", "queries"):
+        for (name, value) in flatten_results(results[section]):
+            line = section + "." + name + ": " + format_number(value)
+            if baseline is not None:
+                baseline_value = dict(flatten_results(baseline.get(section, dict()))).get(name)
+                if baseline_value:
+                    line += " (baseline " + format_number(baseline_value) + ", " + \
+                        "{:+.1f}%".format(100 * (value - baseline_value) / baseline_value) + ")"
+            print(line)
+
+# Returns the (dotted name, number) tuples of the nested results.
+def flatten_results(results, prefix = empty_string):
+    flat = []
+    for (name, value) in results.items():
+        if isinstance(value, dict):
+            flat.extend(flatten_results(value, prefix + name + "."))
+        elif isinstance(value, (int, float)):
+            flat.append((prefix + name, value))
+    return flat
+
+def format_number(value):
+    if isinstance(value, int):
+        return str(value)
+    return "{:.3f}".format(value)
+
+def usage():
+    print ("usage: " + sys.argv[0] + " -g directory-of-documents -n number-of-documents [-r seed] [-l words-per-document]")
+    print ("       " + sys.argv[0] + " -i directory-of-documents -w work-directory [-o results-file] [-b baseline-file]")
+    print ("           [-q number-of-queries] [-e repeats] [-r seed] [-x index-options] [-y search-options]")
+    print ("  -g  generates a synthetic legal corpus into the directory")
+    print ("  -i  indexes the corpus into the work directory and runs a query mix on it")
+    print ("  -o  writes the results as JSON")
+    print ("  -b  compares the results against the results of an earlier run")
+    print ("  -x  extra options of index.py, such as \"-t regex -j 4\"")
+    print ("  -y  extra options of search.py, such as \"-k 10 -c 100000000\"")
+
+if __name__ == "__main__":
+    generated_directory = directory_of_documents = work_directory = results_file = baseline_file = None
+    document_count = None
+    document_words = 400
+    query_count = 60
+    repeats = 3
+    seed = default_seed
+    index_options = []
+    search_options = []
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'g:n:l:i:w:o:b:q:e:r:x:y:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == '-g':
+            generated_directory = a
+        elif o == '-n':
+            document_count = int(a)
+        elif o == '-l':
+            document_words = int(a)
+        elif o == '-i':
+            directory_of_documents = a
+        elif o == '-w':
+            work_directory = a
+        elif o == '-o':
+            results_file = a
+        elif o == '-b':
+            baseline_file = a
+        elif o == '-q':
+            query_count = int(a)
+        elif o == '-e':
+            repeats = int(a)
+        elif o == '-r':
+            seed = int(a)
+        elif o == '-x':
+            index_options = shlex.split(a)
+        elif o == '-y':
+            search_options = shlex.split(a)
+        else:
+            assert False, "unhandled option"
+
+    if generated_directory != None and document_count != None and document_count > 0:
+        generate_corpus(generated_directory, document_count, seed, document_words)
+        print("generated " + str(document_count) + " documents in " + generated_directory)
+    elif directory_of_documents != None and work_directory != None and query_count > 0 and repeats > 0:
+        results = run_benchmark(directory_of_documents, work_directory, query_count, repeats, seed,
+            index_options, search_options)
+        baseline = None
+        if baseline_file != None:
+            with open(baseline_file, mode="r") as bf:
+                baseline = json.load(bf)
+        print_results(results, baseline)
+        if results_file != None:
+            with open(results_file, mode="w") as rf:
+                json.dump(results, rf, indent=2, sort_keys=True)
+    else:
+        usage()
+        sys.exit(2)
@@ -0,0 +1,315 @@
+# Contains the binary format of the postings file and the positions file.
+#
+# The postings file starts with a header made of POSTINGS_MAGIC and one byte holding
+# POSTINGS_VERSION, and the positions file (<postings-file>.pos) with POSITIONS_MAGIC
+# and the same version. Every posting list stores three streams of numbers: the gaps
+# between consecutive doc IDs and the term frequencies in the postings file, and the
+# gaps between the positions of the term inside each document in the positions file.
+# Scoring only reads the postings file, and positions are only read for the phrases
+# and documents whose positions are checked.
+# The documents of a list are split into blocks of POSTINGS_BLOCK_SIZE documents, and
+# two more streams form the block index (skip pointers) of the list: the last doc ID
+# of every block, and the index of the first position of every block.
+# A posting list starts with the number of documents as a variable-byte number, then
+# holds the streams in this order: last doc IDs of the blocks, first positions of the
+# blocks, doc ID gaps and term frequencies. Its position gaps are a single stream in
+# the positions file. Each stream is stored as one
+# byte holding the width (1, 2, 4 or 8 bytes) of its numbers, followed by the numbers
+# as little-endian integers of that width.
+#
+# Fixed-width streams can be decoded by memoryview.cast and itertools.accumulate
+# without a Python loop over bytes. Doc IDs are decoded block by block, and the
+# positions of a document are only decoded when they are asked for.
+#
+# An index built with impacts (index.py -w) also has an impacts file
+# (<postings-file>.imp, starting with IMPACTS_MAGIC and the version), holding an
+# impact-ordered copy of every posting list: its documents grouped by the quantized
+# length-normalized lnc weight (impact) of the term, from the highest impact down
+# (see encode_impacts).
+
+import math
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+POSTINGS_MAGIC = b'LSEP'
+POSITIONS_MAGIC = b'LSEQ'
+POSTINGS_VERSION = 3
+POSTINGS_HEADER_SIZE = len(POSTINGS_MAGIC) + 1
+POSTINGS_BLOCK_SIZE = 128
+POSITIONS_SUFFIX = ".pos"
+IMPACTS_MAGIC = b'LSEI'
+IMPACTS_SUFFIX = ".imp"
+# Length-normalized lnc weights are at most 1, and are quantized to this many levels.
+IMPACT_LEVELS = 1024
+
+# Maps the width of the numbers in a stream to its array / memoryview format.
+width_formats = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+# Returns the path of the positions file that belongs to the given postings file.
+def get_positions_path(postings_file):
+    return postings_file + POSITIONS_SUFFIX
+
+# Returns the path of the impacts file that belongs to the given postings file.
+def get_impacts_path(postings_file):
+    return postings_file + IMPACTS_SUFFIX
+
+# Writes the header of the postings file.
+def write_postings_header(postings_file):
+    postings_file.write(POSTINGS_MAGIC + bytes([POSTINGS_VERSION]))
+
+# Writes the header of the positions file.
+def write_positions_header(positions_file):
+    positions_file.write(POSITIONS_MAGIC + bytes([POSTINGS_VERSION]))
+
+# Writes the header of the impacts file.
+def write_impacts_header(impacts_file):
+    impacts_file.write(IMPACTS_MAGIC + bytes([POSTINGS_VERSION]))
+
+# Checks that the given header was written by this version of the indexer.
+def check_postings_header(header):
+    check_header(header, POSTINGS_MAGIC, "postings file")
+
+def check_positions_header(header):
+    check_header(header, POSITIONS_MAGIC, "positions file")
+
+def check_impacts_header(header):
+    check_header(header, IMPACTS_MAGIC, "impacts file")
+
+def check_header(header, magic, name):
+    if header[:len(magic)] != magic:
+        raise ValueError("not a " + name + ", please rebuild the index")
+    if header[len(magic)] != POSTINGS_VERSION:
+        raise ValueError(name + " has version " + str(header[len(magic)]) +
+            ", expected version " + str(POSTINGS_VERSION) + ", please rebuild the index")
+
+# Appends the variable-byte encoding of number to buf.
+# A variable-byte number stores 7 bits per byte, lowest bits first. The highest bit
+# is only set on the last byte of a number.
+def encode_number(number, buf):
+    while number >= 128:
+        buf.append(number & 127)
+        number >>= 7
+    buf.append(number | 128)
+
+# Decodes the variable-byte number starting at offset in buf.
+# Returns the number and the offset right after it.
+def decode_number(buf, offset):
+    number = shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        if byte & 128:
+            return number | ((byte & 127) << shift), offset
+        number |= byte << shift
+        shift += 7
+
+# Appends the numbers to buf as a fixed-width stream.
+def encode_stream(numbers, buf):
+    largest = max(numbers, default=0)
+    width = 1
+    while largest >= 1 << (8 * width):
+        width *= 2
+    buf.append(width)
+    stream = array(width_formats[width], numbers)
+    if sys.byteorder == 'big':
+        stream.byteswap()
+    buf += stream.tobytes()
+
+# Decodes a stream of count numbers starting at offset in buf.
+# On little-endian machines the stream is a memoryview into buf, so nothing is copied.
+# Returns the stream and the offset right after it.
+def decode_stream(buf, offset, count):
+    width = buf[offset]
+    offset += 1
+    end = offset + count * width
+    if sys.byteorder == 'little':
+        return memoryview(buf)[offset:end].cast(width_formats[width]), end
+    stream = array(width_formats[width], bytes(buf[offset:end]))
+    stream.byteswap()
+    return stream, end
+
+# Encodes a posting list of (doc ID, [positions...]) tuples sorted by doc ID.
+# Returns the bytes of the posting list and the bytes of its positions.
+def encode_postings(postings):
+    doc_ids = []
+    tfs = []
+    position_gaps = []
+    for (doc_id, positions) in postings:
+        doc_ids.append(doc_id)
+        tfs.append(len(positions))
+        previous_position = 0
+        for position in positions:
+            position_gaps.append(position - previous_position)
+            previous_position = position
+    return encode_streams(doc_ids, tfs, position_gaps)
+
+# Encodes the doc IDs, term frequencies and position gaps of a posting list.
+def encode_streams(doc_ids, tfs, position_gaps):
+    doc_gaps = [doc_id - previous_doc_id for (previous_doc_id, doc_id) in zip([0] + doc_ids, doc_ids)]
+    block_last_doc_ids = doc_ids[POSTINGS_BLOCK_SIZE - 1::POSTINGS_BLOCK_SIZE]
+    if len(doc_ids) % POSTINGS_BLOCK_SIZE != 0:
+        block_last_doc_ids.append(doc_ids[-1])
+    block_position_starts = [0]
+    block_position_starts.extend(accumulate(tfs))
+    block_position_starts = block_position_starts[:len(tfs):POSTINGS_BLOCK_SIZE]
+    buf = bytearray()
+    encode_number(len(tfs), buf)
+    encode_stream(block_last_doc_ids, buf)
+    encode_stream(block_position_starts, buf)
+    encode_stream(doc_gaps, buf)
+    encode_stream(tfs, buf)
+    positions_buf = bytearray()
+    encode_stream(position_gaps, positions_buf)
+    return bytes(buf), bytes(positions_buf)
+
+# Encodes the concatenation of decoded posting lists, where every list only holds
+# doc IDs larger than the ones of the lists before it. The positions are copied as
+# they are, without being decoded.
+# Returns the bytes of the posting list and the bytes of its positions.
+def concatenate_postings(postings_lists):
+    doc_ids = []
+    tfs = []
+    position_gaps = []
+    for postings in postings_lists:
+        doc_ids.extend(postings.doc_ids)
+        tfs.extend(postings.tfs)
+        position_gaps.extend(postings.position_gaps)
+    return encode_streams(doc_ids, tfs, position_gaps)
+
+# Decodes a posting list and its positions written by encode_postings.
+# The positions are not decoded until they are asked for.
+def decode_postings(buf, positions_buf):
+    (count, offset) = decode_number(buf, 0)
+    block_count = (count + POSTINGS_BLOCK_SIZE - 1) // POSTINGS_BLOCK_SIZE
+    (block_last_doc_ids, offset) = decode_stream(buf, offset, block_count)
+    (block_position_starts, offset) = decode_stream(buf, offset, block_count)
+    (doc_gaps, offset) = decode_stream(buf, offset, count)
+    (tfs, offset) = decode_stream(buf, offset, count)
+    return Postings(count, block_last_doc_ids, block_position_starts, doc_gaps, tfs, positions_buf)
+
+# Returns the impact of a length-normalized lnc weight: the weight times IMPACT_LEVELS,
+# rounded up. A weight whose impact is q is larger than (q - 1) / IMPACT_LEVELS and
+# at most q / IMPACT_LEVELS.
+def get_impact(weight):
+    return min(max(math.ceil(weight * IMPACT_LEVELS), 1), IMPACT_LEVELS)
+
+# Encodes the impact-ordered copy of a posting list, given the length-normalized lnc
+# weight of the term in each of its documents: the number of groups as a
+# variable-byte number, then, for every impact from the highest down, the impact and
+# the number of documents with that impact as variable-byte numbers, and the gaps
+# between their sorted doc IDs as a stream.
+def encode_impacts(doc_ids, weights):
+    groups = dict()
+    for (doc_id, weight) in zip(doc_ids, weights):
+        groups.setdefault(get_impact(weight), []).append(doc_id)
+    buf = bytearray()
+    encode_number(len(groups), buf)
+    for impact in sorted(groups, reverse=True):
+        group = sorted(groups[impact])
+        encode_number(impact, buf)
+        encode_number(len(group), buf)
+        encode_stream([doc_id - previous_doc_id for (previous_doc_id, doc_id) in zip([0] + group, group)], buf)
+    return bytes(buf)
+
+# Decodes the groups of an impact-ordered posting list written by encode_impacts, as
+# (impact, [doc IDs...]) tuples from the highest impact down. A group is only decoded
+# when it is asked for, so the low impacts are not decoded if reading stops early.
+def decode_impacts(buf):
+    (group_count, offset) = decode_number(buf, 0)
+    for group in range(group_count):
+        (impact, offset) = decode_number(buf, offset)
+        (count, offset) = decode_number(buf, offset)
+        (doc_gaps, offset) = decode_stream(buf, offset, count)
+        yield impact, list(accumulate(doc_gaps))
+
+# A decoded posting list. Doc IDs are decoded when they are asked for, either all at
+# once (doc_ids) or block by block (doc_id and seek), and the positions of a document
+# are only decoded by positions(i). The positions buffer is not touched before that.
+# Iterating over it gives the (doc ID, [positions...]) tuples the list was encoded from.
+class Postings:
+    def __init__(self, count, block_last_doc_ids, block_position_starts, doc_gaps, tfs, positions_buf):
+        self.count = count
+        self.block_last_doc_ids = block_last_doc_ids
+        self.block_position_starts = block_position_starts
+        self.doc_gaps = doc_gaps
+        self.tfs = tfs
+        self.positions_buf = positions_buf
+        self.all_position_gaps = None
+        self.all_doc_ids = None
+        self.blocks = dict()
+        # The doc IDs as a NumPy array, built by scoring.py.
+        self.doc_id_array = None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        start = 0
+        for (doc_id, tf) in zip(self.doc_ids, self.tfs):
+            yield doc_id, list(accumulate(self.position_gaps[start:start + tf]))
+            start += tf
+
+    # All doc IDs of the list.
+    @property
+    def doc_ids(self):
+        if self.all_doc_ids is None:
+            self.all_doc_ids = list(accumulate(self.doc_gaps))
+        return self.all_doc_ids
+
+    # The position gaps of all documents of the list.
+    @property
+    def position_gaps(self):
+        if self.all_position_gaps is None:
+            width = self.positions_buf[0]
+            (self.all_position_gaps, offset) = decode_stream(self.positions_buf, 0, (len(self.positions_buf) - 1) // width)
+        return self.all_position_gaps
+
+    # Returns the doc IDs of the given block.
+    def get_block(self, block):
+        if self.all_doc_ids is not None:
+            return self.all_doc_ids[block * POSTINGS_BLOCK_SIZE:(block + 1) * POSTINGS_BLOCK_SIZE]
+        if block not in self.blocks:
+            previous_doc_id = self.block_last_doc_ids[block - 1] if block > 0 else 0
+            doc_gaps = self.doc_gaps[block * POSTINGS_BLOCK_SIZE:(block + 1) * POSTINGS_BLOCK_SIZE]
+            self.blocks[block] = list(accumulate(doc_gaps, initial = previous_doc_id))[1:]
+        return self.blocks[block]
+
+    # Returns the i-th doc ID of the list.
+    def doc_id(self, i):
+        if self.all_doc_ids is not None:
+            return self.all_doc_ids[i]
+        return self.get_block(i // POSTINGS_BLOCK_SIZE)[i % POSTINGS_BLOCK_SIZE]
+
+    # Returns the index of the first doc ID that is not smaller than doc_id, searching
+    # from index i on, or the length of the list if there is none.
+    # It gallops over the last doc IDs of the blocks, and only decodes the block that
+    # holds the result.
+    def seek(self, doc_id, i):
+        if i >= self.count:
+            return self.count
+        block = i // POSTINGS_BLOCK_SIZE
+        block_count = len(self.block_last_doc_ids)
+        if self.block_last_doc_ids[block] < doc_id:
+            low = block
+            high = block + 1
+            step = 1
+            while high < block_count and self.block_last_doc_ids[high] < doc_id:
+                low = high
+                step *= 2
+                high = low + step
+            block = bisect_left(self.block_last_doc_ids, doc_id, low + 1, min(high + 1, block_count))
+            if block == block_count:
+                return self.count
+            i = block * POSTINGS_BLOCK_SIZE
+        doc_ids = self.get_block(block)
+        return block * POSTINGS_BLOCK_SIZE + bisect_left(doc_ids, doc_id, i - block * POSTINGS_BLOCK_SIZE)
+
+    # Returns the positions of the term in the i-th document of the list.
+    def positions(self, i):
+        block_start = i - i % POSTINGS_BLOCK_SIZE
+        start = self.block_position_starts[i // POSTINGS_BLOCK_SIZE] + sum(self.tfs[block_start:i])
+        return list(accumulate(self.position_gaps[start:start + self.tfs[i]]))
+
+empty_postings = Postings(0, [], [], [], [], bytes([1]))
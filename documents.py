@@ -0,0 +1,74 @@
+# Contains the document table: the filename and the length of every document.
+#
+# index.py numbers the documents of an index with dense internal doc IDs 0..N-1,
+# given in sorted filename order, and the posting lists, the field store and the
+# score dictionaries of search.py use them instead of the filenames. Because the
+# internal doc IDs follow the order of the filenames, documents are in the same order
+# either way, and search.py translates the doc IDs back to filenames only for the
+# results it writes.
+#
+# The document table (<dictionary-file>.docs) starts with DOCUMENTS_MAGIC, one byte
+# holding DOCUMENTS_VERSION and 3 bytes of padding, then the number of documents as
+# an 8-byte little-endian number, followed by two flat columns indexed by the doc ID:
+# - the filenames, as 8-byte little-endian unsigned numbers;
+# - the lengths of the documents, as 8-byte little-endian doubles.
+# Both columns are read into typed arrays without unpickling anything.
+
+import os
+import sys
+from array import array
+from bisect import bisect_left
+
+DOCUMENTS_MAGIC = b'LSED'
+DOCUMENTS_VERSION = 1
+DOCUMENTS_SUFFIX = ".docs"
+DOCUMENTS_HEADER_SIZE = 16
+
+# Returns the path of the document table that belongs to the given dictionary file.
+def get_documents_path(dictionary_file):
+    return dictionary_file + DOCUMENTS_SUFFIX
+
+# Writes the document table, given the sorted filenames of the documents and their
+# lengths, in the same order.
+def write_document_table(documents_path, filenames, doc_lengths):
+    filenames = array('Q', filenames)
+    doc_lengths = array('d', doc_lengths)
+    if sys.byteorder == 'big':
+        filenames.byteswap()
+        doc_lengths.byteswap()
+    with open(documents_path, mode="wb") as df:
+        df.write(DOCUMENTS_MAGIC + bytes([DOCUMENTS_VERSION, 0, 0, 0]))
+        df.write(len(filenames).to_bytes(8, 'little'))
+        df.write(filenames.tobytes())
+        df.write(doc_lengths.tobytes())
+
+# Reads the document table.
+# Returns the filenames and the lengths of the documents, as arrays indexed by doc ID.
+# Indexes built before the document table have none, and are rebuilt.
+def read_document_table(documents_path):
+    if not os.path.exists(documents_path):
+        raise ValueError("no document table " + documents_path + ", please rebuild the index")
+    with open(documents_path, mode="rb") as df:
+        header = df.read(DOCUMENTS_HEADER_SIZE)
+        if header[:len(DOCUMENTS_MAGIC)] != DOCUMENTS_MAGIC:
+            raise ValueError("not a document table, please rebuild the index")
+        if header[len(DOCUMENTS_MAGIC)] != DOCUMENTS_VERSION:
+            raise ValueError("document table has version " + str(header[len(DOCUMENTS_MAGIC)]) +
+                ", expected version " + str(DOCUMENTS_VERSION) + ", please rebuild the index")
+        count = int.from_bytes(header[8:], 'little')
+        filenames = array('Q')
+        filenames.frombytes(df.read(8 * count))
+        doc_lengths = array('d')
+        doc_lengths.frombytes(df.read(8 * count))
+    if sys.byteorder == 'big':
+        filenames.byteswap()
+        doc_lengths.byteswap()
+    return filenames, doc_lengths
+
+# Returns the doc ID of the document with the given filename, or None if it is not
+# in filenames, the sorted filenames of a document table.
+def get_doc_id(filenames, filename):
+    doc_id = bisect_left(filenames, filename)
+    if doc_id < len(filenames) and filenames[doc_id] == filename:
+        return doc_id
+    return None
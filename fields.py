@@ -0,0 +1,168 @@
+# Contains the field store: the court and the tag of every document, and its static
+# prior, the score update_score_by_fields in search.py adds for them.
+#
+# The field store (<dictionary-file>.fld) starts with FIELDS_MAGIC and one byte holding
+# FIELDS_VERSION, then the number of documents as a variable-byte number, followed by
+# columns that hold one entry per document, in doc ID order (see codec.py for the
+# streams):
+# - the doc IDs, as a stream;
+# - the court of every document, as a stream of small integers (court codes);
+# - the tags, as a bitset with one bit per document;
+# - the static priors, as 8-byte little-endian doubles.
+# The court names of the codes are pickled after the columns, and the file ends with
+# the offset of the court names as an 8-byte little-endian number.
+#
+# The columns are read from the memory-mapped file without unpickling or copying
+# them. The store of an index holds the dense doc IDs 0..N-1 (see documents.py), so
+# the index of a document in the columns is its doc ID; the stores of the runs of
+# index.py hold a range of them, and a document is found by a binary search over the
+# doc ID column.
+
+import mmap
+import pickle
+import sys
+from array import array
+from bisect import bisect_left
+from codec import encode_number, decode_number, encode_stream, decode_stream
+import scoring
+from utility import *
+
+FIELDS_MAGIC = b'LSEF'
+FIELDS_VERSION = 1
+FIELDS_SUFFIX = ".fld"
+
+# Returns the path of the field store that belongs to the given dictionary file.
+def get_fields_path(dictionary_file):
+    return dictionary_file + FIELDS_SUFFIX
+
+# Returns the static prior of a document with the given court and tag: the score of
+# its court in courts_score (SGCA > SGHC > SG** > **CA > other), plus tag_score if it
+# has tags, as they are considered landmark cases. Documents without a court get none.
+def get_static_prior(court, tag):
+    prior = 0
+    if court == None:
+        return prior
+    if court in courts_score:
+        prior += courts_score[court]
+    elif len(court) >= 2:
+        prefix = court[:2] # for exanple, `SG`
+        if prefix in courts_score:
+            prior += courts_score[prefix]
+        subfix = court[-2:]  # for example, `CA`
+        if subfix in courts_score:
+            prior += courts_score[subfix]
+    if tag:
+        prior += tag_score
+    return prior
+
+# Writes the field store of the documents in courts, a dictionary mapping doc IDs to
+# their courts, given tags, a dictionary mapping doc IDs to whether they have tags.
+def write_field_store(fields_path, courts, tags):
+    doc_ids = sorted(courts)
+    court_names = []
+    court_codes = dict()
+    codes = []
+    for doc_id in doc_ids:
+        court = courts[doc_id]
+        if court not in court_codes:
+            court_codes[court] = len(court_names)
+            court_names.append(court)
+        codes.append(court_codes[court])
+    tag_bits = bytearray((len(doc_ids) + 7) // 8)
+    for (i, doc_id) in enumerate(doc_ids):
+        if tags.get(doc_id, False):
+            tag_bits[i // 8] |= 1 << (i % 8)
+    priors = array('d', [get_static_prior(courts[doc_id], tags.get(doc_id, False)) for doc_id in doc_ids])
+    if sys.byteorder == 'big':
+        priors.byteswap()
+
+    buf = bytearray(FIELDS_MAGIC + bytes([FIELDS_VERSION]))
+    encode_number(len(doc_ids), buf)
+    encode_stream(doc_ids, buf)
+    encode_stream(codes, buf)
+    buf += tag_bits
+    buf += priors.tobytes()
+    court_names_offset = len(buf)
+    buf += pickle.dumps(court_names)
+    buf += court_names_offset.to_bytes(8, 'little')
+    with open(fields_path, mode="wb") as ff:
+        ff.write(buf)
+
+# Looks up the fields of documents in a field store file.
+class FieldStore:
+    def __init__(self, fields_path):
+        self.fields_file = open(fields_path, mode="rb")
+        self.fields_map = mmap.mmap(self.fields_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fields_view = memoryview(self.fields_map)
+        if self.fields_view[:len(FIELDS_MAGIC)] != FIELDS_MAGIC:
+            raise ValueError("not a field store, please rebuild the index")
+        if self.fields_view[len(FIELDS_MAGIC)] != FIELDS_VERSION:
+            raise ValueError("field store has version " + str(self.fields_view[len(FIELDS_MAGIC)]) +
+                ", expected version " + str(FIELDS_VERSION) + ", please rebuild the index")
+        (self.count, offset) = decode_number(self.fields_view, len(FIELDS_MAGIC) + 1)
+        (self.doc_ids, offset) = decode_stream(self.fields_view, offset, self.count)
+        (self.court_codes, offset) = decode_stream(self.fields_view, offset, self.count)
+        self.tag_bits = self.fields_view[offset:offset + (self.count + 7) // 8]
+        offset += len(self.tag_bits)
+        if sys.byteorder == 'little':
+            self.priors = self.fields_view[offset:offset + 8 * self.count].cast('d')
+        else:
+            self.priors = array('d', bytes(self.fields_view[offset:offset + 8 * self.count]))
+            self.priors.byteswap()
+        court_names_offset = int.from_bytes(self.fields_view[-8:], 'little')
+        self.court_names = pickle.loads(self.fields_view[court_names_offset:-8])
+        # Whether the doc IDs are 0..count-1, so each one is its own index.
+        self.dense = self.count == 0 or self.doc_ids[self.count - 1] == self.count - 1
+        # The doc IDs and the priors as NumPy arrays, built by scoring.py.
+        self.doc_id_array = None
+        self.prior_array = None
+
+    def __len__(self):
+        return self.count
+
+    # Iterates over the doc IDs of the stored documents, in order.
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return self.get_index(doc_id) is not None
+
+    # Returns the index of the document in the columns, or None if it is not stored.
+    def get_index(self, doc_id):
+        if self.dense:
+            return doc_id if 0 <= doc_id < self.count else None
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < self.count and self.doc_ids[i] == doc_id:
+            return i
+        return None
+
+    # Returns the court of the document.
+    def get_court(self, doc_id):
+        return self.court_names[self.court_codes[self.get_index(doc_id)]]
+
+    # Tells whether the document has tags.
+    def has_tag(self, doc_id):
+        i = self.get_index(doc_id)
+        return bool(self.tag_bits[i // 8] & (1 << (i % 8)))
+
+    # Returns the static prior of the document, or 0 if it is not stored.
+    def get_prior(self, doc_id):
+        i = self.get_index(doc_id)
+        if i is None:
+            return 0
+        return self.priors[i]
+
+    # Adds the static prior of every document to its score in score_dictionary.
+    def add_priors(self, score_dictionary):
+        if scoring.vectorized and len(score_dictionary) >= scoring.vectorized_min_postings:
+            score_dictionary.update(scoring.get_prior_scores(score_dictionary, self))
+            return
+        for doc_id in score_dictionary:
+            score_dictionary[doc_id] += self.get_prior(doc_id)
+
+    def close(self):
+        self.doc_ids = self.court_codes = self.tag_bits = self.priors = None
+        self.doc_id_array = self.prior_array = None
+        self.fields_view.release()
+        self.fields_map.close()
+        self.fields_file.close()
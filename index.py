@@ -1,15 +1,28 @@
 #!/usr/bin/python
-from nltk import sent_tokenize, word_tokenize
 from nltk.corpus import stopwords
 import os
 import getopt
 import sys
 import re
 from node import Node
+from codec import write_postings_header, write_positions_header, write_impacts_header, get_positions_path, \
+    get_impacts_path, encode_postings, encode_streams, decode_postings, concatenate_postings, encode_impacts
+from lexicon import Lexicon, LexiconWriter, get_lexicon_path
+from fields import FieldStore, write_field_store, get_fields_path
+from documents import write_document_table, read_document_table, get_documents_path, get_doc_id
+from segments import get_segment_files, read_manifest, write_manifest, remove_manifest
+from shards import get_shard_files, split_collection, read_shard_count
 import pickle
 import xml.etree.ElementTree as ET
 from utility import *
 import datetime
+import multiprocessing
+import heapq
+from array import array
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Builds index for all documents in directory-of-documents and
 # writes the dictionary into dictionary-file and the postings into postings-file.
@@ -22,38 +35,227 @@ dictionary[CONTENT_INDEX] = dict()
 dictionary[COURT] = dict()
 dictionary[TAG] = dict()
 
+# Number of documents in one chunk of the collection that a worker process indexes.
+documents_per_flush = 3500
+# Bytes of postings accumulated in memory before they are written to disk as a run
+# (see index_documents), unless --mem-limit is given.
+default_memory_limit = 256 << 20
+# Estimated bytes of memory of the buffers of a term, besides its postings.
+term_buffer_bytes = 400
+# With -b, biwords (see process_content) in at least this many documents are indexed.
+# Pairs of words that are in fewer documents are cheap to match with their positions.
+min_biword_doc_frequency = 2
+# Added segments with fewer live documents than this are merged by compact_segments.
+small_segment_size = documents_per_flush
+
 # Builds index for all documents in file_path.
-def process_documents(file_path, dictionary_file, postings_file):
+# If jobs is greater than 1, documents are parsed and tokenized by that many
+# worker processes (see process_documents_in_parallel).
+# Documents are split into words by the tokenizer named tokenizer_name (see utility.py).
+# If impacts is set, an impact-ordered copy of every posting list is written too
+# (see merge_runs).
+# Postings are written to a run whenever they take about memory_limit bytes in
+# memory, memory_limit / jobs in every worker (see index_documents).
+# Documents are numbered with dense internal doc IDs, their positions in the sorted
+# collection, and the filename of every doc ID is stored in the document table (see
+# documents.py).
+# If biword_doc_frequency is given, the pairs of adjacent terms in at least that many
+# documents are indexed too, as biwords (see process_content).
+# If collection is given, only the documents with these sorted doc IDs are indexed.
+def process_documents(file_path, dictionary_file, postings_file, jobs = 1, tokenizer_name = NLTK_TOKENIZER,
+    impacts = False, memory_limit = default_memory_limit, biword_doc_frequency = 0, collection = None):
     print('building index...')
-    print('Please delete existing dictionary, postings and temporary files')
     start = datetime.datetime.now()
+    set_tokenizer(tokenizer_name)
     temp_postings_file = "temp_posting"
 
+    if collection is None:
+        collection = get_collection(file_path)
+    if jobs > 1:
+        (run_files, doc_length_table, token_count, spill_stats) = process_documents_in_parallel(file_path,
+            collection, temp_postings_file, jobs, tokenizer_name, memory_limit, biword_doc_frequency > 0)
+    else:
+        (run_files, doc_length_table, token_count, spill_stats) = index_documents(file_path, collection, 0,
+            temp_postings_file, memory_limit, biword_doc_frequency > 0)
+    merge_dictionary(run_files, dictionary_file, postings_file, doc_length_table, impacts, biword_doc_frequency)
+    # The courts and tags are written to the field store after the postings are merged,
+    # so they are not in memory together.
+    (courts, tags) = read_run_fields(run_files)
+    write_field_store(get_fields_path(dictionary_file), courts, tags)
+    for run_file in run_files:
+        os.remove(run_file)
+        os.remove(get_fields_path(run_file))
+    dictionary[COLLECTION_SIZE] = len(collection)
+    dictionary[TOKENIZER] = tokenizer_name
+    dictionary[IMPACTS] = impacts
+    dictionary[BIWORDS] = biword_doc_frequency
+    # The content index is stored in the lexicon, and the courts and tags in the field
+    # store, so only the settings of the index are pickled.
+    write_dict_to_disk({key: dictionary[key] for key in (COLLECTION_SIZE, TOKENIZER, IMPACTS, BIWORDS)},
+        collection, doc_length_table, dictionary_file)
+    end = datetime.datetime.now()
+    print(str(end - start))
+    seconds = max((end - start).total_seconds(), 1e-6)
+    print(str(token_count) + ' tokens, ' + str(int(token_count / seconds)) + ' tokens/s')
+    print_spill_stats(spill_stats, memory_limit)
+    print('...index is done building')
+
+# Returns the sorted doc IDs of the documents in file_path.
+def get_collection(file_path):
     collection = [int(filename[:-len(xml)]) for filename in os.listdir(file_path) if filename != ".DS_Store"]
     collection.sort()
-    doc_length_table = dict()
-    i = 0
-    for filename in collection:
+    return collection
+
+# Builds a sharded index (see shards.py) of all documents in file_path: shard_count
+# shards of consecutive documents, each indexed like process_documents indexes the
+# whole collection. The dictionary file then holds the settings of the index and
+# the number of shards, and its lexicon the document frequencies of all terms in the
+# whole collection, summed over the lexicons of the shards. Biwords are only used by
+# the shards, and are left out of it.
+# Returns the number of shards, which is at most the number of documents.
+def process_shards(file_path, dictionary_file, postings_file, shard_count, jobs = 1, tokenizer_name = NLTK_TOKENIZER,
+    impacts = False, memory_limit = default_memory_limit, biword_doc_frequency = 0):
+    collection = get_collection(file_path)
+    shard_count = max(1, min(shard_count, len(collection)))
+    for (number, shard_collection) in enumerate(split_collection(collection, shard_count)):
+        print('shard ' + str(number) + ' of ' + str(shard_count) + ':')
+        (shard_dictionary_file, shard_postings_file) = get_shard_files(dictionary_file, postings_file, number)
+        process_documents(file_path, shard_dictionary_file, shard_postings_file, jobs, tokenizer_name, impacts,
+            memory_limit, biword_doc_frequency, shard_collection)
+
+    # The files of an index built without shards are removed.
+    remove_index_files(dictionary_file, postings_file)
+    lexicons = [Lexicon(get_lexicon_path(get_shard_files(dictionary_file, postings_file, number)[0]))
+        for number in range(shard_count)]
+    lexicon_writer = LexiconWriter(get_lexicon_path(dictionary_file))
+    term = None
+    doc_frequency = 0
+    for node in heapq.merge(*lexicons, key=Node.get_term):
+        if is_biword(node.get_term()):
+            continue
+        if node.get_term() != term:
+            if term is not None:
+                lexicon_writer.add(Node(term, doc_frequency, 0, 0))
+            term = node.get_term()
+            doc_frequency = 0
+        doc_frequency += node.get_doc_frequency()
+    if term is not None:
+        lexicon_writer.add(Node(term, doc_frequency, 0, 0))
+    lexicon_writer.close()
+    for lexicon in lexicons:
+        lexicon.close()
+    with open(dictionary_file, mode="wb") as df:
+        pickle.dump([{COLLECTION_SIZE: len(collection), TOKENIZER: tokenizer_name, IMPACTS: impacts,
+            BIWORDS: biword_doc_frequency, SHARDS: shard_count}], df)
+    return shard_count
+
+# Removes the shards first_shard, first_shard + 1, ... of an index that had
+# shard_count shards, after it is rebuilt with fewer shards, or without shards.
+def remove_shards(dictionary_file, postings_file, first_shard, shard_count):
+    for number in range(first_shard, shard_count):
+        remove_index_files(*get_shard_files(dictionary_file, postings_file, number))
+
+# Splits the sorted collection into chunks of consecutive documents and indexes them
+# in `jobs` worker processes, each within memory_limit / jobs bytes. Every worker writes
+# the runs of its chunk into run files of its own. The runs are listed in collection
+# order, so the merge sees exactly the same postings as in the serial path.
+# Returns the run files, the doc lengths, the number of tokens in the collection and
+# the spill statistics (see index_documents) of all workers.
+def process_documents_in_parallel(file_path, collection, temp_postings_file, jobs, tokenizer_name, memory_limit,
+    biwords = False):
+    chunks = []
+    for start in range(0, len(collection), documents_per_flush):
+        chunks.append((file_path, collection[start:start + documents_per_flush], start,
+            get_run_file(temp_postings_file, len(chunks)), tokenizer_name, memory_limit // jobs, biwords))
+
+    run_files = []
+    doc_length_table = array('d')
+    token_count = 0
+    spill_stats = new_spill_stats()
+    with multiprocessing.Pool(jobs) as pool:
+        for (chunk_run_files, chunk_doc_length_table, tokens, chunk_spill_stats) in pool.imap(index_chunk, chunks):
+            run_files.extend(chunk_run_files)
+            doc_length_table.extend(chunk_doc_length_table)
+            token_count += tokens
+            add_spill_stats(spill_stats, chunk_spill_stats)
+    return run_files, doc_length_table, token_count, spill_stats
+
+# Indexes one chunk of documents inside a worker process.
+def index_chunk(chunk):
+    (file_path, filenames, first_doc_id, run_prefix, tokenizer_name, memory_limit, biwords) = chunk
+    set_tokenizer(tokenizer_name)
+    return index_documents(file_path, filenames, first_doc_id, run_prefix, memory_limit, biwords)
+
+# Indexes the documents with the given filenames into the global dictionary, as doc
+# IDs first_doc_id, first_doc_id + 1, ..., and writes it to a new run (named
+# run_prefix.<n>) whenever the estimated size of its postings (see update_dictionary)
+# reaches memory_limit bytes, and after the last document.
+# The courts and tags of the documents of a run are written next to it, as a field
+# store. If biwords is set, the biwords of the documents are indexed too.
+# Returns the run files, the lengths of the documents (an array in doc ID order), the
+# number of tokens of the documents and the spill statistics: the number of runs, the
+# bytes written to them and the largest estimated size of the postings in memory.
+def index_documents(file_path, filenames, first_doc_id, run_prefix, memory_limit, biwords = False):
+    run_files = []
+    doc_length_table = array('d')
+    token_count = 0
+    memory_used = 0
+    spill_stats = new_spill_stats()
+    for (i, filename) in enumerate(filenames):
         (content, court, tag) = parse_xml(file_path, filename)
-        (doc_length, term_index_table) = process_content(content)
-        update_dictionary(filename, term_index_table, court, tag)
-        doc_length_table[filename] = doc_length
-        term_index_table.clear()
-        i += 1
-        if i > 3500:
+        (doc_length, term_index_table, tokens) = process_content(content, biwords)
+        token_count += tokens
+        memory_used += update_dictionary(first_doc_id + i, term_index_table, court, tag)
+        doc_length_table.append(doc_length)
+        if memory_used >= memory_limit or i == len(filenames) - 1:
             # The collection is too big that it cannot fit into memory.
             # Thus, we will write perioridically write dict to disk,
             # and clear some memory.
-            write_temp_dict_to_disk(dictionary_file, temp_postings_file)
+            run_files.append(get_run_file(run_prefix, len(run_files)))
+            write_run_to_disk(dictionary[CONTENT_INDEX], run_files[-1])
+            write_field_store(get_fields_path(run_files[-1]), dictionary[COURT], dictionary[TAG])
+            spill_stats["runs"] += 1
+            spill_stats["run_bytes"] += os.path.getsize(run_files[-1])
+            spill_stats["largest_buffer_bytes"] = max(spill_stats["largest_buffer_bytes"], memory_used)
             dictionary[CONTENT_INDEX].clear()
-            i = 0
-    write_temp_dict_to_disk(dictionary_file, temp_postings_file)
-    dictionary[CONTENT_INDEX] = merge_dictionary(dictionary_file, postings_file, temp_postings_file)
-    dictionary[COLLECTION_SIZE] = len(collection)
-    write_dict_to_disk(dictionary, doc_length_table, dictionary_file)
-    end = datetime.datetime.now()
-    print(str(end - start))
-    print('...index is done building')
+            dictionary[COURT].clear()
+            dictionary[TAG].clear()
+            memory_used = 0
+    return run_files, doc_length_table, token_count, spill_stats
+
+# Returns empty spill statistics (see index_documents).
+def new_spill_stats():
+    return {"runs": 0, "run_bytes": 0, "largest_buffer_bytes": 0}
+
+# Adds the spill statistics of a worker to spill_stats.
+def add_spill_stats(spill_stats, worker_spill_stats):
+    spill_stats["runs"] += worker_spill_stats["runs"]
+    spill_stats["run_bytes"] += worker_spill_stats["run_bytes"]
+    spill_stats["largest_buffer_bytes"] = max(spill_stats["largest_buffer_bytes"],
+        worker_spill_stats["largest_buffer_bytes"])
+
+# Prints the spill statistics and the peak memory of the indexer, and of its largest
+# worker process, if the system reports it.
+def print_spill_stats(spill_stats, memory_limit):
+    print(str(spill_stats["runs"]) + ' runs, ' + str(spill_stats["run_bytes"]) + ' bytes spilled, largest buffer ' +
+        str(spill_stats["largest_buffer_bytes"]) + ' bytes (limit ' + str(memory_limit) + ' bytes)')
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        workers_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print('peak memory ' + str(peak // 1024) + ' MB, workers ' + str(workers_peak // 1024) + ' MB')
+
+# Reads the courts and tags of the documents of the runs from their field stores.
+def read_run_fields(run_files):
+    courts = dict()
+    tags = dict()
+    for run_file in run_files:
+        field_store = FieldStore(get_fields_path(run_file))
+        for doc_id in field_store:
+            courts[doc_id] = field_store.get_court(doc_id)
+            tags[doc_id] = field_store.has_tag(doc_id)
+        field_store.close()
+    return courts, tags
 
 # parse_xml reads the xml file and gets the useful tags
 def parse_xml(file_path, filename):
@@ -87,13 +289,20 @@ def parse_xml(file_path, filename):
     return content, court, tag
 
 # process_content processes the content of given file and computes a term positional index
-# table for the content and the length of the content.
-def process_content(content):
+# table for the content, the length of the content and the number of its tokens.
+# If biwords is set, the table also holds the biword (see get_biword in utility.py) of
+# every two adjacent different terms. The position of a pair of adjacent terms is
+# twice the position of its first term, plus one if its terms are not in sorted
+# order, so search.py can tell which term of the pair is where (see
+# get_biword_matches). Biwords do not count towards the length of the document.
+def process_content(content, biwords = False):
     term_frequency_table = dict()
     term_index_table = dict()
+    terms = []
     index = 0
 
-    for word in word_tokenize(content):
+    words = tokenize(content)
+    for word in words:
         term = normalize(word)
         if term == empty_string:
             continue
@@ -102,9 +311,18 @@ def process_content(content):
             term_index_table[term] = []
         term_frequency_table[term] += 1
         term_index_table[term].append(index)
+        terms.append(term)
         index += 1
     doc_length = calculate_doc_length(term_frequency_table.values())
-    return (doc_length, term_index_table)
+    if biwords:
+        for (index, (term, next_term)) in enumerate(zip(terms, terms[1:])):
+            if term == next_term:
+                continue
+            biword = get_biword(term, next_term)
+            if biword not in term_index_table:
+                term_index_table[biword] = []
+            term_index_table[biword].append(2 * index + (term > next_term))
+    return (doc_length, term_index_table, len(words))
 
 # Calculates the length of the log_tf vector for the document.
 def calculate_doc_length(term_frequencies):
@@ -138,84 +356,420 @@ def process_title(title):
 # update_dictionary takes the doc id, term positional index table, court and tag info
 # and updates the global dictionary after processing each document in
 # the collection
+# Returns the estimated number of bytes of memory the postings of the document take.
 def update_dictionary(doc_ID, term_index_table, court, tag):
+    memory_used = 0
     for term in term_index_table:
         if term not in dictionary[CONTENT_INDEX]:
-            dictionary[CONTENT_INDEX][term] = []
-        postings_element = (doc_ID, term_index_table[term])
-        dictionary[CONTENT_INDEX][term].append(postings_element)
+            dictionary[CONTENT_INDEX][term] = PostingsBuffer()
+            memory_used += term_buffer_bytes + len(term)
+        memory_used += dictionary[CONTENT_INDEX][term].add(doc_ID, term_index_table[term])
 
     dictionary[COURT][doc_ID] = court
     dictionary[TAG][doc_ID] = tag
+    return memory_used
 
-# Write the temp content dict to disk.
-def write_temp_dict_to_disk(dictionary_file, postings_file):
-    temp_dict_to_disk = write_content_post_to_disk(dictionary[CONTENT_INDEX], postings_file)
-    with open(dictionary_file, mode="a+b") as df:
-        pickle.dump(temp_dict_to_disk, df)
-
-# Writes postings to disk and gets dict_to_disk.
-# dict_to_disk[CONTENT_INDEXT] is a dictionary, where terms in content are keys,
-# and Node`s that point to the postings are stored as values in the dictionary.
-# The tuple in each posting for content represents (doc ID, term positional index table).
-def write_content_post_to_disk(content_dictionary, postings_file):
-    with open(postings_file, mode="a+b") as pf:
-        dict_to_disk = dict()
-        for key in content_dictionary:
-            dict_to_disk[key] = Node(key, len(content_dictionary[key]), pf.tell(), pf.write(pickle.dumps(content_dictionary[key])))
-    return dict_to_disk
-
-# Writes dictionary_file and doc_length_table to disk.
-def write_dict_to_disk(dict_to_disk, doc_length_table, dictionary_file):
-    with open(dictionary_file, mode="wb") as df:
-        data = [dict_to_disk, doc_length_table]
-        pickle.dump(data, df)
+# The postings of a term that are accumulated in memory, in array-backed buffers
+# instead of lists of (doc ID, [positions...]) tuples: the doc IDs, the term
+# frequencies and the gaps between the positions in each document, which are the
+# streams codec.py encodes.
+class PostingsBuffer:
+    __slots__ = ("doc_ids", "tfs", "position_gaps")
+
+    def __init__(self):
+        self.doc_ids = array('Q')
+        self.tfs = array('I')
+        self.position_gaps = array('I')
+
+    # Adds the positions of the term in a document. Returns the number of bytes added.
+    def add(self, doc_id, positions):
+        self.doc_ids.append(doc_id)
+        self.tfs.append(len(positions))
+        self.position_gaps.extend([position - previous_position
+            for (previous_position, position) in zip([0] + positions, positions)])
+        return self.doc_ids.itemsize + self.tfs.itemsize + len(positions) * self.position_gaps.itemsize
 
-# Merge dictionaries.
-def merge_dictionary(dictionary_file, postings_file, temp_postings_file):
-    merged_dictionary = dict()
-    with open(dictionary_file, 'rb') as df:
+    # Returns the bytes of the posting list and the bytes of its positions.
+    def encode(self):
+        return encode_streams(self.doc_ids.tolist(), self.tfs, self.position_gaps)
+
+# Returns the name of the n-th run file.
+def get_run_file(temp_postings_file, n):
+    return temp_postings_file + "." + str(n)
+
+# Writes the content dict to a run file.
+# A run holds one record per term, in sorted term order. A record is the length of
+# the term, the term, the length of the posting list and the posting list, where the
+# lengths are 4-byte little-endian numbers and the posting list is in the binary
+# format of codec.py.
+# The PostingsBuffer of each term holds its postings.
+def write_run_to_disk(content_dictionary, run_file):
+    with open(run_file, mode="wb") as rf:
+        for key in sorted(content_dictionary):
+            term = key.encode()
+            (postings, positions) = content_dictionary[key].encode()
+            rf.write(len(term).to_bytes(4, 'little'))
+            rf.write(term)
+            rf.write(len(postings).to_bytes(4, 'little'))
+            rf.write(postings)
+            rf.write(len(positions).to_bytes(4, 'little'))
+            rf.write(positions)
+
+# Reads the records of a run file one by one, as (term, posting list) tuples.
+def read_run_from_disk(run_file):
+    with open(run_file, mode="rb") as rf:
         while True:
-            try:
-                temp_dictionary = pickle.load(df)
-            except EOFError:
+            length = rf.read(4)
+            if not length:
                 break
-            else:
-                for key, value in temp_dictionary.items():
-                    if key not in merged_dictionary:
-                        merged_dictionary[key] = []
-                    merged_dictionary[key].append(value)
-    with open(temp_postings_file, mode="rb") as tpf, open(postings_file, mode="wb") as pf:
-        for key, value in merged_dictionary.items():
-            postings = []
-            for node in value:
-                offset = node.get_pointer() - tpf.tell()
-                tpf.seek(offset, 1)
-                postings.extend(pickle.loads(tpf.read(node.length)))
-            merged_dictionary[key] = Node(key, len(merged_dictionary[key]), pf.tell(), pf.write(pickle.dumps(postings)))
-            postings.clear()
-    return merged_dictionary
+            term = rf.read(int.from_bytes(length, 'little')).decode()
+            postings = rf.read(int.from_bytes(rf.read(4), 'little'))
+            positions = rf.read(int.from_bytes(rf.read(4), 'little'))
+            postings = decode_postings(postings, positions)
+            yield term, postings
+
+# Writes dictionary_file to disk, and the filenames and doc_length_table of the
+# documents to its document table.
+def write_dict_to_disk(dict_to_disk, filenames, doc_length_table, dictionary_file):
+    with open(dictionary_file, mode="wb") as df:
+        data = [dict_to_disk]
+        pickle.dump(data, df)
+    write_document_table(get_documents_path(dictionary_file), filenames, doc_length_table)
+
+# Reads the dictionary, the filenames and the doc length table written by
+# write_dict_to_disk.
+def read_dict_from_disk(dictionary_file):
+    with open(dictionary_file, mode="rb") as df:
+        data = pickle.load(df)
+    (filenames, doc_length_table) = read_document_table(get_documents_path(dictionary_file))
+    return data[0], filenames, doc_length_table
+
+# Indexes the documents in file_path into a new segment of the index (see segments.py)
+# instead of rebuilding it. Documents that are already in the index are replaced:
+# their older copies become tombstones.
+def add_documents(file_path, dictionary_file, postings_file, jobs = 1, memory_limit = default_memory_limit):
+    manifest = read_manifest(dictionary_file)
+    # A segment is tokenized like the index it is added to, and has impacts and biwords
+    # if it has.
+    base_dictionary = read_dict_from_disk(dictionary_file)[0]
+    tokenizer_name = base_dictionary.get(TOKENIZER, NLTK_TOKENIZER)
+    number = manifest["next_segment"]
+    (segment_dictionary_file, segment_postings_file) = get_segment_files(dictionary_file, postings_file, number)
+    process_documents(file_path, segment_dictionary_file, segment_postings_file, jobs, tokenizer_name,
+        base_dictionary.get(IMPACTS, False), memory_limit, base_dictionary.get(BIWORDS, 0))
+
+    filenames = read_dict_from_disk(segment_dictionary_file)[1]
+    add_tombstones(manifest, dictionary_file, postings_file, filenames)
+    manifest["segments"].append(number)
+    manifest["tombstones"][number] = set()
+    manifest["next_segment"] = number + 1
+    write_manifest(dictionary_file, manifest)
+    print('added segment ' + str(number) + ' with ' + str(len(filenames)) + ' documents')
+
+# Deletes the documents with the given filenames from the index, as tombstones.
+def delete_documents(filenames, dictionary_file, postings_file):
+    manifest = read_manifest(dictionary_file)
+    count = add_tombstones(manifest, dictionary_file, postings_file, filenames)
+    write_manifest(dictionary_file, manifest)
+    print('deleted ' + str(count) + ' documents')
+
+# Records the live copies of the documents with the given filenames as tombstones of
+# their segments in manifest. Tombstones are filenames, since the internal doc IDs of
+# every segment are its own.
+# Returns the number of documents that are deleted.
+def add_tombstones(manifest, dictionary_file, postings_file, filenames):
+    count = 0
+    for number in manifest["segments"]:
+        (segment_dictionary_file, segment_postings_file) = get_segment_files(dictionary_file, postings_file, number)
+        segment_filenames = read_dict_from_disk(segment_dictionary_file)[1]
+        tombstones = manifest["tombstones"][number]
+        for filename in filenames:
+            if get_doc_id(segment_filenames, filename) is not None and filename not in tombstones:
+                tombstones.add(filename)
+                count += 1
+    return count
+
+# Merges the added segments that have fewer than small_segment_size live documents
+# into one new segment, and leaves their tombstoned documents out. The segment built
+# by a full run of index.py is never merged; its tombstones are dropped by the next
+# full run.
+# The manifest is switched to the new segment before the merged segments are removed,
+# so it can run in the background while search.py answers queries.
+def compact_segments(dictionary_file, postings_file):
+    manifest = read_manifest(dictionary_file)
+    small_segments = []
+    for number in manifest["segments"][1:]:
+        (segment_dictionary_file, segment_postings_file) = get_segment_files(dictionary_file, postings_file, number)
+        segment_filenames = read_dict_from_disk(segment_dictionary_file)[1]
+        if len(segment_filenames) - len(manifest["tombstones"][number]) < small_segment_size:
+            small_segments.append(number)
+    if len(small_segments) < 2:
+        print('no segments to compact')
+        return
+
+    print('compacting segments ' + ', '.join(map(str, small_segments)) + '...')
+    compacted = dict()
+    courts = dict()
+    tags = dict()
+    base_dictionary = read_dict_from_disk(dictionary_file)[0]
+    compacted[TOKENIZER] = base_dictionary.get(TOKENIZER, NLTK_TOKENIZER)
+    compacted[IMPACTS] = base_dictionary.get(IMPACTS, False)
+    compacted[BIWORDS] = base_dictionary.get(BIWORDS, 0)
+    # The live documents get new doc IDs, in the sorted order of their filenames.
+    segment_tables = dict()
+    filenames = []
+    for number in small_segments:
+        (segment_dictionary_file, segment_postings_file) = get_segment_files(dictionary_file, postings_file, number)
+        segment_tables[number] = read_dict_from_disk(segment_dictionary_file)[1:]
+        tombstones = manifest["tombstones"][number]
+        filenames.extend(filename for filename in segment_tables[number][0] if filename not in tombstones)
+    filenames.sort()
+    doc_length_table = array('d', bytes(8 * len(filenames)))
+    runs = []
+    for number in small_segments:
+        (segment_dictionary_file, segment_postings_file) = get_segment_files(dictionary_file, postings_file, number)
+        (segment_filenames, segment_doc_length_table) = segment_tables[number]
+        segment_fields = FieldStore(get_fields_path(segment_dictionary_file))
+        tombstones = manifest["tombstones"][number]
+        # The new doc ID of every live document of the segment.
+        doc_ids = dict()
+        for (segment_doc_id, filename) in enumerate(segment_filenames):
+            if filename in tombstones:
+                continue
+            doc_id = doc_ids[segment_doc_id] = get_doc_id(filenames, filename)
+            doc_length_table[doc_id] = segment_doc_length_table[segment_doc_id]
+            courts[doc_id] = segment_fields.get_court(segment_doc_id)
+            tags[doc_id] = segment_fields.has_tag(segment_doc_id)
+        segment_fields.close()
+        runs.append(read_segment_from_disk(segment_dictionary_file, segment_postings_file, doc_ids))
+
+    number = manifest["next_segment"]
+    (compacted_dictionary_file, compacted_postings_file) = get_segment_files(dictionary_file, postings_file, number)
+    merge_runs(runs, compacted_dictionary_file, compacted_postings_file, doc_length_table, compacted[IMPACTS],
+        compacted[BIWORDS], biwords_in_all_runs = True)
+    compacted[COLLECTION_SIZE] = len(doc_length_table)
+    write_field_store(get_fields_path(compacted_dictionary_file), courts, tags)
+    write_dict_to_disk(compacted, filenames, doc_length_table, compacted_dictionary_file)
+
+    manifest["segments"] = [old for old in manifest["segments"] if old not in small_segments] + [number]
+    for old in small_segments:
+        del manifest["tombstones"][old]
+    manifest["tombstones"][number] = set()
+    manifest["next_segment"] = number + 1
+    write_manifest(dictionary_file, manifest)
+    for old in small_segments:
+        remove_segment_files(dictionary_file, postings_file, old)
+    print('...compacted into segment ' + str(number) + ' with ' + str(len(doc_length_table)) + ' documents')
+
+# Removes the added segments and the manifest, after a full run of index.py has
+# rebuilt the index from all documents.
+def remove_added_segments(dictionary_file, postings_file):
+    for number in read_manifest(dictionary_file)["segments"][1:]:
+        remove_segment_files(dictionary_file, postings_file, number)
+    remove_manifest(dictionary_file)
+
+def remove_segment_files(dictionary_file, postings_file, number):
+    remove_index_files(*get_segment_files(dictionary_file, postings_file, number))
+
+# Removes the files of the index in dictionary_file and postings_file, if they exist.
+def remove_index_files(dictionary_file, postings_file):
+    for path in (dictionary_file, get_lexicon_path(dictionary_file), get_fields_path(dictionary_file),
+        get_documents_path(dictionary_file), postings_file, get_positions_path(postings_file),
+        get_impacts_path(postings_file)):
+        if os.path.exists(path):
+            os.remove(path)
+
+# Reads the posting lists of a segment one by one in term order, as (term, posting
+# list) tuples like read_run_from_disk, with the doc IDs of the segment replaced by
+# their new doc IDs in doc_ids. Documents that are not in doc_ids are left out.
+def read_segment_from_disk(segment_dictionary_file, segment_postings_file, doc_ids):
+    lexicon = Lexicon(get_lexicon_path(segment_dictionary_file))
+    with open(segment_postings_file, mode="rb") as pf, open(get_positions_path(segment_postings_file), mode="rb") as posf:
+        for node in lexicon:
+            pf.seek(node.get_pointer())
+            posf.seek(node.get_positions_pointer())
+            postings = decode_postings(pf.read(node.length), posf.read(node.positions_length))
+            # New doc IDs are in the same order as the old ones, so the list stays sorted.
+            live_postings = [(doc_ids[doc_id], positions) for (doc_id, positions) in postings if doc_id in doc_ids]
+            if not live_postings:
+                continue
+            yield node.get_term(), decode_postings(*encode_postings(live_postings))
+    lexicon.close()
+
+# Merges the runs into the postings file, its positions file (and impacts file) and
+# the lexicon of dictionary_file.
+def merge_dictionary(run_files, dictionary_file, postings_file, doc_length_table, impacts = False,
+    biword_doc_frequency = 0):
+    merge_runs([read_run_from_disk(run_file) for run_file in run_files], dictionary_file, postings_file,
+        doc_length_table, impacts, biword_doc_frequency)
+
+# Merges runs of (term, posting list) tuples sorted by term.
+# The runs are merged with a heap of the next record of every run: each run is read
+# sequentially, and only one record per run is held in memory. Runs of index.py are
+# listed in collection order, so the posting lists of a term are concatenated in run
+# order; the lists of compacted segments can interleave and are merged by doc ID
+# (see combine_postings).
+# The max weight of every term (see node.py) is computed from doc_length_table.
+# If impacts is set, the length-normalized lnc weights of every posting list are
+# quantized and written, in impact order, to the impacts file (see codec.py).
+# Otherwise the impacts file of an earlier build is removed. Biwords have no impacts.
+# Biwords in fewer than biword_doc_frequency documents are left out.
+# The runs of compacted segments had their rare biwords left out already, so a biword
+# missing from one of them may still occur in its documents: if biwords_in_all_runs is
+# set, a biword is only kept if every run has its posting list.
+def merge_runs(runs, dictionary_file, postings_file, doc_length_table, impacts = False, biword_doc_frequency = 0,
+    biwords_in_all_runs = False):
+    lexicon_writer = LexiconWriter(get_lexicon_path(dictionary_file))
+    heap = []
+    for (run_number, run) in enumerate(runs):
+        push_next_record(heap, run, run_number)
+    impacts_file = None
+    if impacts:
+        impacts_file = open(get_impacts_path(postings_file), mode="wb")
+        write_impacts_header(impacts_file)
+    elif os.path.exists(get_impacts_path(postings_file)):
+        os.remove(get_impacts_path(postings_file))
+    with open(postings_file, mode="wb") as pf, open(get_positions_path(postings_file), mode="wb") as posf:
+        write_postings_header(pf)
+        write_positions_header(posf)
+        while heap:
+            term = heap[0][0]
+            postings_lists = []
+            while heap and heap[0][0] == term:
+                (term, run_number, postings) = heapq.heappop(heap)
+                postings_lists.append(postings)
+                push_next_record(heap, runs[run_number], run_number)
+            # The document frequency is the number of postings, not the number of runs.
+            doc_frequency = sum(len(postings) for postings in postings_lists)
+            if is_biword(term) and (doc_frequency < biword_doc_frequency or
+                (biwords_in_all_runs and len(postings_lists) < len(runs))):
+                continue
+            max_weight = get_max_weight(postings_lists, doc_length_table)
+            impacts_pointer = impacts_size = 0
+            if impacts_file is not None and not is_biword(term):
+                impacts_pointer = impacts_file.tell()
+                impacts_size = impacts_file.write(encode_impacts(*get_weights(postings_lists, doc_length_table)))
+            (postings, positions) = combine_postings(postings_lists)
+            lexicon_writer.add(Node(term, doc_frequency, pf.tell(), pf.write(postings),
+                posf.tell(), posf.write(positions), max_weight, impacts_pointer, impacts_size))
+    if impacts_file is not None:
+        impacts_file.close()
+    lexicon_writer.close()
+
+# Encodes the union of non-empty posting lists. Lists that follow each other in doc ID
+# order are concatenated without decoding their positions, otherwise they are merged.
+def combine_postings(postings_lists):
+    for (previous, postings) in zip(postings_lists, postings_lists[1:]):
+        if previous.doc_id(len(previous) - 1) >= postings.doc_id(0):
+            return encode_postings(heapq.merge(*postings_lists))
+    return concatenate_postings(postings_lists)
+
+# Returns the largest length-normalized lnc weight of the term in the posting lists.
+def get_max_weight(postings_lists, doc_length_table):
+    max_weight = 0.0
+    for postings in postings_lists:
+        for (doc_id, tf) in zip(postings.doc_ids, postings.tfs):
+            max_weight = max(max_weight, calculate_log_tf(tf) / doc_length_table[doc_id])
+    return max_weight
+
+# Returns the doc IDs of the posting lists and the length-normalized lnc weight of
+# the term in each of them.
+def get_weights(postings_lists, doc_length_table):
+    doc_ids = []
+    weights = []
+    for postings in postings_lists:
+        for (doc_id, tf) in zip(postings.doc_ids, postings.tfs):
+            doc_ids.append(doc_id)
+            weights.append(calculate_log_tf(tf) / doc_length_table[doc_id])
+    return doc_ids, weights
+
+# Pushes the next record of the run onto the heap, if the run has one left.
+# Records of the same term are popped in run order, because the run number breaks ties.
+def push_next_record(heap, run, run_number):
+    record = next(run, None)
+    if record is not None:
+        heapq.heappush(heap, (record[0], run_number, record[1]))
 
 def usage():
-    print ("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file")
+    print ("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file [-j number-of-jobs] [-t nltk|regex] [-w] [-a]")
+    print ("       [-n number-of-shards] [-b] [--mem-limit bytes]")
+    print ("       " + sys.argv[0] + " -d dictionary-file -p postings-file -r file-of-doc-ids")
+    print ("       " + sys.argv[0] + " -d dictionary-file -p postings-file -c")
+    print ("  --mem-limit  writes postings to disk whenever they take about this many bytes of memory")
+    print ("  -w  also writes impact-ordered posting lists, used by search.py -k")
+    print ("  -n  splits the index into shards, which search.py queries in parallel")
+    print ("  -b  also indexes the pairs of adjacent words that are in several documents, used to match phrases")
+    print ("  -a  adds the documents to the index as a new segment, instead of rebuilding it")
+    print ("  -r  deletes the documents whose doc IDs are listed in the file, one per line")
+    print ("  -c  merges the small added segments of the index")
 
-directory_of_documents = dictionary_file = postings_file = None
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-for o, a in opts:
-    if o == '-i':
-        directory_of_documents = a
-    elif o == '-d':
-        dictionary_file = a
-    elif o == '-p':
-        postings_file = a
-    else:
-        assert False, "unhandled option"
-if directory_of_documents == None or dictionary_file == None or postings_file == None:
-    usage()
-    sys.exit(2)
+# The guard keeps worker processes from re-running the indexer when they import this module.
+if __name__ == "__main__":
+    directory_of_documents = dictionary_file = postings_file = deleted_documents_file = None
+    add = compact = impacts = False
+    jobs = 1
+    shard_count = 0
+    biword_doc_frequency = 0
+    tokenizer_name = NLTK_TOKENIZER
+    memory_limit = default_memory_limit
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:j:t:war:cn:b', ["mem-limit="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == '-i':
+            directory_of_documents = a
+        elif o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-j':
+            jobs = int(a)
+        elif o == '-t':
+            tokenizer_name = a
+        elif o == '-w':
+            impacts = True
+        elif o == '-a':
+            add = True
+        elif o == '-r':
+            deleted_documents_file = a
+        elif o == '-c':
+            compact = True
+        elif o == '-n':
+            shard_count = int(a)
+        elif o == '-b':
+            biword_doc_frequency = min_biword_doc_frequency
+        elif o == '--mem-limit':
+            memory_limit = int(a)
+        else:
+            assert False, "unhandled option"
+    if dictionary_file == None or postings_file == None or jobs < 1 or memory_limit < 1 or shard_count < 0 \
+        or tokenizer_name not in (NLTK_TOKENIZER, REGEX_TOKENIZER):
+        usage()
+        sys.exit(2)
+    old_shard_count = read_shard_count(dictionary_file)
+    if old_shard_count > 0 and (deleted_documents_file != None or compact or add):
+        print("documents cannot be added to or deleted from a sharded index, please rebuild it")
+        sys.exit(2)
 
-process_documents(directory_of_documents, dictionary_file, postings_file)
+    if deleted_documents_file != None:
+        with open(deleted_documents_file, mode="r") as ddf:
+            delete_documents([int(line) for line in ddf if line.strip()], dictionary_file, postings_file)
+    elif compact:
+        compact_segments(dictionary_file, postings_file)
+    elif directory_of_documents == None:
+        usage()
+        sys.exit(2)
+    elif add:
+        add_documents(directory_of_documents, dictionary_file, postings_file, jobs, memory_limit)
+    elif shard_count > 0:
+        shard_count = process_shards(directory_of_documents, dictionary_file, postings_file, shard_count, jobs,
+            tokenizer_name, impacts, memory_limit, biword_doc_frequency)
+        remove_added_segments(dictionary_file, postings_file)
+        remove_shards(dictionary_file, postings_file, shard_count, old_shard_count)
+    else:
+        process_documents(directory_of_documents, dictionary_file, postings_file, jobs, tokenizer_name, impacts,
+            memory_limit, biword_doc_frequency)
+        remove_added_segments(dictionary_file, postings_file)
+        remove_shards(dictionary_file, postings_file, 0, old_shard_count)
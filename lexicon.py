@@ -0,0 +1,149 @@
+# Contains the on-disk term dictionary (lexicon) of the content index.
+#
+# The lexicon file starts with LEXICON_MAGIC and one byte holding LEXICON_VERSION.
+# Terms are stored in sorted order, in blocks of at most LEXICON_BLOCK_SIZE terms.
+# Inside a block, every term is front-coded against the previous one: the number
+# of bytes it shares with the previous term, the number of remaining bytes and the
+# remaining bytes, followed by the document frequency, the pointer and length of its
+# posting list and the pointer and length of its positions as variable-byte numbers
+# (see codec.py), its max weight as an 8-byte little-endian double, and the pointer
+# and length of its impact-ordered posting list (0 if the index has no impacts).
+# The blocks are followed by the block index, a pickled pair of lists holding the
+# first term and the offset of every block, and the file ends with the offset of the
+# block index as an 8-byte little-endian number.
+#
+# Only the block index is loaded into memory. Looking up a term decodes a single
+# block from the memory-mapped file.
+
+import mmap
+import pickle
+import struct
+from bisect import bisect_right
+from node import Node
+from codec import encode_number, decode_number
+
+LEXICON_MAGIC = b'LSEL'
+LEXICON_VERSION = 4
+LEXICON_BLOCK_SIZE = 32
+LEXICON_SUFFIX = ".lex"
+
+# Returns the path of the lexicon that belongs to the given dictionary file.
+def get_lexicon_path(dictionary_file):
+    return dictionary_file + LEXICON_SUFFIX
+
+# Writes Node`s, added in sorted term order, to a lexicon file.
+class LexiconWriter:
+    def __init__(self, lexicon_path):
+        self.lexicon_file = open(lexicon_path, mode="wb")
+        self.lexicon_file.write(LEXICON_MAGIC + bytes([LEXICON_VERSION]))
+        self.block = bytearray()
+        self.block_size = 0
+        self.previous_term = b''
+        self.first_terms = []
+        self.block_offsets = []
+
+    def add(self, node):
+        term = node.get_term().encode()
+        if self.block_size == LEXICON_BLOCK_SIZE:
+            self.flush_block()
+        if self.block_size == 0:
+            self.first_terms.append(node.get_term())
+            self.block_offsets.append(self.lexicon_file.tell())
+            self.previous_term = b''
+        shared = 0
+        while shared < len(term) and shared < len(self.previous_term) and term[shared] == self.previous_term[shared]:
+            shared += 1
+        encode_number(shared, self.block)
+        encode_number(len(term) - shared, self.block)
+        self.block += term[shared:]
+        encode_number(node.get_doc_frequency(), self.block)
+        encode_number(node.get_pointer(), self.block)
+        encode_number(node.length, self.block)
+        encode_number(node.get_positions_pointer(), self.block)
+        encode_number(node.positions_length, self.block)
+        self.block += struct.pack('<d', node.get_max_weight())
+        encode_number(node.get_impacts_pointer(), self.block)
+        encode_number(node.impacts_length, self.block)
+        self.previous_term = term
+        self.block_size += 1
+
+    def flush_block(self):
+        self.lexicon_file.write(self.block)
+        self.block.clear()
+        self.block_size = 0
+
+    def close(self):
+        self.flush_block()
+        block_index_offset = self.lexicon_file.tell()
+        pickle.dump((self.first_terms, self.block_offsets), self.lexicon_file)
+        self.lexicon_file.write(block_index_offset.to_bytes(8, 'little'))
+        self.lexicon_file.close()
+
+# Looks up Node`s in a lexicon file. It can be used like the dictionary of Node`s it
+# replaces: `term in lexicon`, `lexicon[term]` and `lexicon.get(term)`.
+class Lexicon:
+    def __init__(self, lexicon_path):
+        self.lexicon_file = open(lexicon_path, mode="rb")
+        self.lexicon_map = mmap.mmap(self.lexicon_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.lexicon_map[:len(LEXICON_MAGIC)] != LEXICON_MAGIC:
+            raise ValueError("not a lexicon file, please rebuild the index")
+        if self.lexicon_map[len(LEXICON_MAGIC)] != LEXICON_VERSION:
+            raise ValueError("lexicon file has version " + str(self.lexicon_map[len(LEXICON_MAGIC)]) +
+                ", expected version " + str(LEXICON_VERSION) + ", please rebuild the index")
+        self.block_index_offset = int.from_bytes(self.lexicon_map[-8:], 'little')
+        (self.first_terms, self.block_offsets) = pickle.loads(self.lexicon_map[self.block_index_offset:-8])
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __getitem__(self, term):
+        node = self.get(term)
+        if node is None:
+            raise KeyError(term)
+        return node
+
+    # Iterates over all Node`s in sorted term order.
+    def __iter__(self):
+        for block in range(len(self.first_terms)):
+            yield from self.iter_block(block)
+
+    # Returns the Node of the given term, or default if the term is not in the lexicon.
+    def get(self, term, default = None):
+        block = bisect_right(self.first_terms, term) - 1
+        if block < 0:
+            return default
+        for node in self.iter_block(block):
+            if node.get_term() == term:
+                return node
+            if node.get_term() > term:
+                break
+        return default
+
+    # Decodes the Node`s of the given block one by one.
+    def iter_block(self, block):
+        offset = self.block_offsets[block]
+        if block + 1 < len(self.block_offsets):
+            end = self.block_offsets[block + 1]
+        else:
+            end = self.block_index_offset
+        term = b''
+        while offset < end:
+            (shared, offset) = decode_number(self.lexicon_map, offset)
+            (suffix_length, offset) = decode_number(self.lexicon_map, offset)
+            term = term[:shared] + self.lexicon_map[offset:offset + suffix_length]
+            offset += suffix_length
+            (doc_frequency, offset) = decode_number(self.lexicon_map, offset)
+            (pointer, offset) = decode_number(self.lexicon_map, offset)
+            (length, offset) = decode_number(self.lexicon_map, offset)
+            (positions_pointer, offset) = decode_number(self.lexicon_map, offset)
+            (positions_length, offset) = decode_number(self.lexicon_map, offset)
+            (max_weight,) = struct.unpack_from('<d', self.lexicon_map, offset)
+            offset += 8
+            (impacts_pointer, offset) = decode_number(self.lexicon_map, offset)
+            (impacts_length, offset) = decode_number(self.lexicon_map, offset)
+            yield Node(term.decode(), doc_frequency, pointer, length, positions_pointer, positions_length, max_weight,
+                impacts_pointer, impacts_length)
+
+    def close(self):
+        self.lexicon_map.close()
+        self.lexicon_file.close()
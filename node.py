@@ -1,13 +1,26 @@
 # Node class represent every key in the dictionary. It contains a String 
 # representing the token, a number representing the frequency, and a pointer
-# to the posting in disk
+# to the posting in disk.
+# positions_pointer and positions_size locate the positions of the posting in the
+# positions file (see codec.py).
+# max_weight is the largest length-normalized lnc weight, (1 + log(tf)) / doc length,
+# of the term in any document. It is an upper bound of what the term can add to the
+# normalized score of a document.
+# impacts_pointer and impacts_size locate the impact-ordered copy of the posting in
+# the impacts file, if the index has one (see codec.py).
 
 class Node:
-    def __init__(self, term, doc_frequency, pointer, size):
+    def __init__(self, term, doc_frequency, pointer, size, positions_pointer = 0, positions_size = 0, max_weight = 0.0,
+        impacts_pointer = 0, impacts_size = 0):
         self.term = term
         self.doc_frequency = doc_frequency
         self.pointer = pointer
         self.length = size
+        self.positions_pointer = positions_pointer
+        self.positions_length = positions_size
+        self.max_weight = max_weight
+        self.impacts_pointer = impacts_pointer
+        self.impacts_length = impacts_size
 
     def get_term(self):
         return self.term
@@ -15,9 +28,18 @@ class Node:
     def get_doc_frequency(self):
         return self.doc_frequency
 
+    def get_max_weight(self):
+        return self.max_weight
+
     def get_pointer(self):
         return self.pointer
 
+    def get_positions_pointer(self):
+        return self.positions_pointer
+
+    def get_impacts_pointer(self):
+        return self.impacts_pointer
+
     def set_pointer(self, pointer):
         self.pointer = pointer
 
@@ -25,4 +47,5 @@ class Node:
         self.length = length
     
     def print_node(self):
-        print (self.term, self.doc_frequency, self.pointer, self.length)
+        print (self.term, self.doc_frequency, self.pointer, self.length, self.positions_pointer, self.positions_length, self.max_weight,
+            self.impacts_pointer, self.impacts_length)
@@ -1,4 +1,3 @@
-from nltk import word_tokenize
 from utility import *
 import re
 from nltk.corpus import stopwords
@@ -12,11 +11,17 @@ def parse_query(query_file_path):
 # To make sure we can get accurate synonyms later, here we return
 # three forms of the query: phrsal query, tokenized but not stemmed query,
 # and tokenized and stemmed query (the actual query).
+# Only the first line of the query file is read.
 def query_from_file_to_array(query_file_path):
-    notstemmed_query = []
-    query = []
     f1 = open(query_file_path, 'r', encoding = "utf8")
     line = f1.readline()
+    f1.close()
+    return query_from_line(line)
+
+# Parses one line holding a query into the three forms described above.
+def query_from_line(line):
+    notstemmed_query = []
+    query = []
     phrases = [f.group(1) for f in re.finditer('"(.+?)"', line)]
 
     for phrase in phrases:
@@ -25,12 +30,11 @@ def query_from_file_to_array(query_file_path):
         notstemmed_query.append(notstemmed_word_dict)
         query.append(word_dict)
 
-    f1.close()
     return phrases, query, notstemmed_query
 
 # Parses the given phrase.
 def parse_phrase(phrase):
-    words = word_tokenize(phrase)
+    words = tokenize(phrase)
     pos = 0
     notstemmed_word_dict = dict()
     word_dict = dict()
@@ -81,5 +85,3 @@ def add_to_dict(word, pos, word_dict):
 #                 query_freq_table[term] += 1
 #             queries.append(query_freq_table)
 #     return queries
-
-parse_query("q1.txt")
@@ -0,0 +1,123 @@
+# Contains the vectorized versions of the tf-idf accumulation in search.py.
+#
+# NumPy is optional. Without it, `vectorized` is False and search.py scores one
+# posting at a time as before. With it, the doc IDs and term frequencies of a posting
+# list are turned into arrays (the term frequencies without a copy, see codec.py),
+# and the scores of all candidates of a phrase are accumulated in a dense array that
+# is indexed by the position of a document among the sorted candidates.
+#
+# The log-tf weights are looked up in a table computed by calculate_log_tf, and every
+# score is accumulated in the same order as in search.py, so the scores are exactly
+# the same as the ones computed one posting at a time.
+
+from utility import *
+
+try:
+    import numpy
+    vectorized = True
+except ImportError:
+    numpy = None
+    vectorized = False
+
+# Posting lists shorter than this are scored one posting at a time, which is faster
+# than building arrays for them.
+vectorized_min_postings = 64
+# Looking a candidate up in a posting list (Postings.seek) costs about as much as
+# scoring this many postings with arrays.
+seek_cost = 256
+
+# log_tf_table[tf] is calculate_log_tf(tf). It is replaced by a larger table when a
+# larger tf is seen.
+log_tf_table = None
+
+# Returns the log-tf weights of the term frequencies in tfs.
+# The threads of the search server can extend the table at the same time, so each
+# one looks tfs up in the table it read or built, and a new table is only published
+# if it is larger than the one another thread may have published in the meantime.
+def get_log_tf_weights(tfs):
+    global log_tf_table
+    max_tf = int(tfs.max()) if len(tfs) > 0 else 0
+    table = log_tf_table
+    if table is None or max_tf >= len(table):
+        size = max(max_tf + 1, 2 * len(table) if table is not None else 256)
+        table = numpy.array([0.0] + [calculate_log_tf(tf) for tf in range(1, size)])
+        if log_tf_table is None or len(log_tf_table) < len(table):
+            log_tf_table = table
+    return table[tfs]
+
+# Returns the doc IDs of the posting list as an array. It is cached on the list.
+def get_doc_id_array(postings):
+    if postings.doc_id_array is None:
+        postings.doc_id_array = numpy.cumsum(numpy.asarray(postings.doc_gaps), dtype=numpy.int64)
+    return postings.doc_id_array
+
+# Returns the term frequencies of the posting list as an array, without a copy.
+def get_tf_array(postings):
+    return numpy.asarray(postings.tfs)
+
+# Accumulates the lnc weights of a posting list, times query_weight, into scores, an
+# array of the scores of the sorted candidate doc IDs in candidate_array. Documents
+# that are not candidates are skipped. touched is set for the candidates in the list.
+def add_postings_scores(scores, touched, candidate_array, postings, query_weight):
+    doc_ids = get_doc_id_array(postings)
+    indexes = numpy.searchsorted(candidate_array, doc_ids)
+    numpy.minimum(indexes, len(candidate_array) - 1, out=indexes)
+    matches = candidate_array[indexes] == doc_ids
+    indexes = indexes[matches]
+    # Doc IDs are unique within a posting list, so every candidate is added to once.
+    scores[indexes] += query_weight * get_log_tf_weights(get_tf_array(postings)[matches])
+    touched[indexes] = True
+
+# Scores the candidates of a phrase whose words are connected by OR, given in doc ID
+# order: the weights of (postings, query_weight) pairs are added up in order for every
+# candidate.
+# Returns the score dictionary of the candidates that are in at least one list.
+def get_candidate_scores(sorted_candidates, weighted_postings):
+    candidate_array = numpy.fromiter(sorted_candidates, dtype=numpy.int64, count=len(sorted_candidates))
+    scores = numpy.zeros(len(candidate_array))
+    touched = numpy.zeros(len(candidate_array), dtype=bool)
+    if len(candidate_array) > 0:
+        for (postings, query_weight) in weighted_postings:
+            add_postings_scores(scores, touched, candidate_array, postings, query_weight)
+    return dict(zip(candidate_array[touched].tolist(), scores[touched].tolist()))
+
+# Scores the candidates of an AND query, given the index of every candidate in every
+# posting list (see intersect_postings in search.py): for every (postings, query_weight,
+# k) triple, the weight of the candidate at its k-th index is added.
+# Returns the scores of the candidates in order.
+def get_conjunctive_scores(candidate_indexes, weighted_postings):
+    scores = numpy.zeros(len(candidate_indexes))
+    if len(candidate_indexes) == 0:
+        return scores.tolist()
+    indexes = numpy.array(candidate_indexes, dtype=numpy.int64)
+    for (postings, query_weight, k) in weighted_postings:
+        scores += query_weight * get_log_tf_weights(get_tf_array(postings)[indexes[:, k]])
+    return scores.tolist()
+
+# Divides the score of every document by its length, looked up in doc_length_table,
+# the array of the doc lengths indexed by doc ID, without a copy.
+# Returns a new score dictionary, in the same order.
+def get_normalized_scores(score_dictionary, doc_length_table):
+    scores = numpy.fromiter(score_dictionary.values(), dtype=float, count=len(score_dictionary))
+    doc_ids = numpy.fromiter(score_dictionary, dtype=numpy.int64, count=len(score_dictionary))
+    doc_lengths = numpy.asarray(doc_length_table)[doc_ids]
+    return dict(zip(score_dictionary, (scores / doc_lengths).tolist()))
+
+# Adds the static prior of every document in field_store (see fields.py) to its score.
+# Returns a new score dictionary, in the same order.
+def get_prior_scores(score_dictionary, field_store):
+    if len(field_store) == 0:
+        return score_dictionary
+    if field_store.doc_id_array is None:
+        field_store.doc_id_array = numpy.asarray(field_store.doc_ids).astype(numpy.int64)
+        field_store.prior_array = numpy.asarray(field_store.priors)
+    doc_ids = numpy.fromiter(score_dictionary, dtype=numpy.int64, count=len(score_dictionary))
+    if field_store.dense:
+        # Every candidate is in the store of its index, at its doc ID.
+        priors = field_store.prior_array[doc_ids]
+    else:
+        indexes = numpy.searchsorted(field_store.doc_id_array, doc_ids)
+        numpy.minimum(indexes, len(field_store) - 1, out=indexes)
+        priors = numpy.where(field_store.doc_id_array[indexes] == doc_ids, field_store.prior_array[indexes], 0.0)
+    scores = numpy.fromiter(score_dictionary.values(), dtype=float, count=len(score_dictionary))
+    return dict(zip(score_dictionary, (scores + priors).tolist()))
@@ -1,73 +1,925 @@
 import getopt
 import sys
+import cProfile
 import pickle
+import mmap
+import socketserver
+import heapq
+import threading
+from collections import OrderedDict
 from queryParser import *
 from node import Node
+from codec import POSTINGS_HEADER_SIZE, IMPACT_LEVELS, check_postings_header, check_positions_header, \
+    check_impacts_header, get_positions_path, get_impacts_path, decode_postings, decode_impacts, empty_postings, Postings
+from lexicon import Lexicon, get_lexicon_path
+from fields import FieldStore, get_fields_path
+from documents import read_document_table, get_documents_path, get_doc_id
+from segments import get_segment_files, read_manifest, get_manifest_version
+from shards import get_shard_files, read_shard_count, start_shard_process, connect_shard, get_shard_error_line
+import scoring
+import tracing
 import math
 from utility import *
+from synonyms import SynonymTable, get_synonyms_path, get_wordnet_synonyms
 from nltk.corpus import wordnet as wn
+import os
 from operator import itemgetter
 
+# Reads the dictionary and the doc length table into memory. The content index is
+# not loaded: it is a Lexicon that reads the terms a query needs from its file, and
+# the fields are a FieldStore that reads them from its memory-mapped file.
+# The doc length table is an array indexed by the internal doc IDs of the index, and
+# dictionary[FILENAMES] holds the filename of every doc ID (see documents.py).
 def read_dictionary_to_memory(dictionary_file_path):
     dictionary = None
-    doc_length_table = None
     with open(dictionary_file_path, mode="rb") as df:
         data = pickle.load(df)
         dictionary = data[0]
-        doc_length_table = data[1]
+    (dictionary[FILENAMES], doc_length_table) = read_document_table(get_documents_path(dictionary_file_path))
+    dictionary[CONTENT_INDEX] = Lexicon(get_lexicon_path(dictionary_file_path))
+    dictionary[FIELDS] = FieldStore(get_fields_path(dictionary_file_path))
+    # The synonym table is optional, without it synonyms are looked up in WordNet.
+    dictionary[SYNONYMS] = None
+    if os.path.exists(get_synonyms_path(dictionary_file_path)):
+        dictionary[SYNONYMS] = SynonymTable(get_synonyms_path(dictionary_file_path))
+    # Queries are split with the tokenizer the index was built with.
+    set_tokenizer(dictionary.get(TOKENIZER, NLTK_TOKENIZER))
     return (dictionary, doc_length_table)
 
-def find_posting_in_disk(dictionary, term, postings_file, tag):
-    if term in dictionary[tag]:
-        offset = dictionary[tag][term].get_pointer() - postings_file.tell()
-        postings_file.seek(offset, 1)
-        return pickle.loads(postings_file.read(dictionary[tag][term].length))
+# Reads posting lists from the postings file and their positions from the positions
+# file. Both files are memory-mapped once, and every posting list is decoded from a
+# memoryview slice of the maps, so looking up a term does not seek, read or copy
+# anything, and the positions file is only touched for positions that are checked.
+# The impacts file is mapped too, if the index has one.
+class PostingsReader:
+    def __init__(self, postings_file_path):
+        self.postings_file = open(postings_file_path, 'rb')
+        self.postings_map = mmap.mmap(self.postings_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.postings_view = memoryview(self.postings_map)
+        check_postings_header(self.postings_view[:POSTINGS_HEADER_SIZE])
+        self.positions_file = open(get_positions_path(postings_file_path), 'rb')
+        self.positions_map = mmap.mmap(self.positions_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.positions_view = memoryview(self.positions_map)
+        check_positions_header(self.positions_view[:POSTINGS_HEADER_SIZE])
+        self.impacts_map = None
+        if os.path.exists(get_impacts_path(postings_file_path)):
+            self.impacts_file = open(get_impacts_path(postings_file_path), 'rb')
+            self.impacts_map = mmap.mmap(self.impacts_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.impacts_view = memoryview(self.impacts_map)
+            check_impacts_header(self.impacts_view[:POSTINGS_HEADER_SIZE])
+
+    # Returns the bytes of the posting list that node points to, as a memoryview slice.
+    def get_buffer(self, node):
+        pointer = node.get_pointer()
+        return self.postings_view[pointer:pointer + node.length]
+
+    # Returns the bytes of the positions of the posting list that node points to.
+    def get_positions_buffer(self, node):
+        pointer = node.get_positions_pointer()
+        return self.positions_view[pointer:pointer + node.positions_length]
+
+    # Returns the posting list that node points to. Doc IDs and term frequencies are
+    # decoded from the map right away, and positions only when they are asked for.
+    def get_postings(self, node):
+        postings = decode_postings(self.get_buffer(node), self.get_positions_buffer(node))
+        if tracing.enabled:
+            tracing.count("postings_lists_decoded")
+            tracing.count("postings_bytes_read", node.length)
+            tracing.count("postings_decoded", len(postings))
+        return postings
+
+    # Returns the groups of the impact-ordered posting list that node points to, from
+    # the highest impact down (see codec.decode_impacts).
+    def get_impacts(self, node):
+        tracing.count("impact_lists_read")
+        pointer = node.get_impacts_pointer()
+        return decode_impacts(self.impacts_view[pointer:pointer + node.impacts_length])
+
+    # Asks the system to read ahead the posting lists of nodes, and the positions of
+    # positions_nodes, before they are decoded (see advise_ranges).
+    def prefetch(self, nodes, positions_nodes):
+        advise_ranges(self.postings_map, [(node.get_pointer(), node.length) for node in nodes])
+        advise_ranges(self.positions_map, [(node.get_positions_pointer(), node.positions_length)
+            for node in positions_nodes])
+
+    def close(self):
+        self.postings_view.release()
+        self.postings_map.close()
+        self.postings_file.close()
+        self.positions_view.release()
+        self.positions_map.close()
+        self.positions_file.close()
+        if self.impacts_map is not None:
+            self.impacts_view.release()
+            self.impacts_map.close()
+            self.impacts_file.close()
+
+# Sorts the (offset, length) ranges of a map by offset, merges the ranges that are
+# less than prefetch_gap bytes apart, and asks the system to read every merged range
+# ahead with madvise. The ranges are then read in offset order, in a few large reads
+# instead of one page fault per posting list.
+# Returns the number of merged ranges.
+def advise_ranges(file_map, ranges):
+    merged = []
+    for (offset, length) in sorted(ranges):
+        if merged and offset - merged[-1][1] < prefetch_gap:
+            merged[-1][1] = max(merged[-1][1], offset + length)
+        else:
+            merged.append([offset, offset + length])
+    if hasattr(mmap, "MADV_WILLNEED"):
+        for (start, end) in merged:
+            start -= start % mmap.PAGESIZE
+            file_map.madvise(mmap.MADV_WILLNEED, start, end - start)
+    return len(merged)
+
+# The posting lists of one query. Every term the query needs, including the terms of
+# the expansion rounds, is looked up in the lexicon and decoded once, and shared by
+# all the scoring rounds of the query.
+# If doc_frequencies is given, the Node`s carry these document frequencies instead of
+# the ones of the lexicon (see run_query_on_segments). Biwords keep the ones of the
+# lexicon, since they only filter documents and are not scored.
+class QueryPostings:
+    def __init__(self, lexicon, postings_reader, doc_frequencies = None):
+        self.lexicon = lexicon
+        self.postings_reader = postings_reader
+        self.doc_frequencies = doc_frequencies
+        self.nodes = dict()
+        self.postings = dict()
+
+    # Returns the Node of the term, or None if the term is not indexed.
+    def get_node(self, term):
+        if term not in self.nodes:
+            node = self.lexicon.get(term)
+            if node is not None and self.doc_frequencies is not None and not is_biword(term):
+                doc_frequency = self.doc_frequencies.get(term, 0)
+                if doc_frequency == 0:
+                    node = None
+                else:
+                    node = Node(term, doc_frequency, node.get_pointer(), node.length, node.get_positions_pointer(),
+                        node.positions_length, node.get_max_weight(), node.get_impacts_pointer(), node.impacts_length)
+            self.nodes[term] = node
+        return self.nodes[term]
+
+    def get_postings(self, node):
+        term = node.get_term()
+        if term not in self.postings:
+            self.postings[term] = self.postings_reader.get_postings(node)
+        return self.postings[term]
+
+    def get_impacts(self, node):
+        return self.postings_reader.get_impacts(node)
+
+# Keeps the most recently used posting lists of all queries in memory, within a budget
+# of cache_bytes, and evicts the least recently used ones. A list is charged its size
+# on disk plus the size of its decoded doc IDs (see get_postings_size).
+# It can be used like the PostingsReader it wraps, also by several threads at once.
+class PostingsCache:
+    def __init__(self, postings_reader, cache_bytes):
+        self.postings_reader = postings_reader
+        self.cache_bytes = cache_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_postings(self, node):
+        key = node.get_pointer()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        postings = self.postings_reader.get_postings(node)
+        size = get_postings_size(node)
+        if size > self.cache_bytes:
+            return postings
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (postings, size)
+                self.used_bytes += size
+            while self.used_bytes > self.cache_bytes:
+                (evicted_postings, evicted_size) = self.entries.popitem(last = False)[1]
+                self.used_bytes -= evicted_size
+                self.evictions += 1
+        return postings
+
+    # Only the posting lists that are not cached are prefetched.
+    def prefetch(self, nodes, positions_nodes):
+        with self.lock:
+            nodes = [node for node in nodes if node.get_pointer() not in self.entries]
+        self.postings_reader.prefetch(nodes, positions_nodes)
+
+    # Impact-ordered lists are read once per query, and are not cached.
+    def get_impacts(self, node):
+        return self.postings_reader.get_impacts(node)
+
+    # Returns the counters of the cache, to size cache_bytes.
+    def get_stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "lists": len(self.entries), "bytes": self.used_bytes, "budget": self.cache_bytes}
+
+    def close(self):
+        self.entries.clear()
+        self.postings_reader.close()
+
+# Returns the number of bytes a cached posting list is charged: its encoded size and
+# decoded_doc_id_bytes for every doc ID.
+def get_postings_size(node):
+    return node.length + node.positions_length + node.get_doc_frequency() * decoded_doc_id_bytes
+
+# Resolves every term of the query and of its expansion rounds, and prefetches their
+# posting lists, and the positions of the terms of phrases, in offset order.
+# Returns the QueryPostings the query is run on.
+def plan_query(query, expansion_rounds, dictionary, postings_reader, doc_frequencies = None):
+    query_postings = QueryPostings(dictionary[CONTENT_INDEX], postings_reader, doc_frequencies)
+    (terms, positional_terms) = get_query_terms(query, expansion_rounds)
+    # Looking terms up in sorted order reads the lexicon blocks in order too.
+    for term in sorted(terms):
+        query_postings.get_node(term)
+    nodes = [node for node in query_postings.nodes.values() if node is not None]
+    postings_reader.prefetch(nodes, [node for node in nodes if node.get_term() in positional_terms])
+    return query_postings
+
+# Returns the terms of the query and of its expansion rounds, and the terms of their
+# phrases, whose positions are checked.
+def get_query_terms(query, expansion_rounds):
+    phrases = list(query)
+    terms = set()
+    for (synonyms, weight, remove_incomplete) in expansion_rounds:
+        terms.update(synonyms)
+        if remove_incomplete:
+            phrases.append(synonyms)
+    positional_terms = set()
+    for phrase in phrases:
+        terms.update(phrase)
+        if len(phrase) > 1:
+            positional_terms.update(phrase)
+    return terms, positional_terms
+
+def find_posting_in_disk(dictionary, term, postings_reader, tag):
+    node = dictionary[tag].get(term)
+    if node is not None:
+        return postings_reader.get_postings(node)
     else:
-        return []
+        return empty_postings
 
 # Runs the query in query_file on dictionary_file and postings_file_path
 # and write results into disk.
+# If top_k is given, only the top_k results are written.
+# endpoints are the ports of the shard servers of a sharded index (see load_index).
+def process_queries(dictionary_file, postings_file_path, query_file, output_file_of_results, top_k = None,
+    endpoints = None):
+    (dictionary, doc_length_table, postings_reader) = load_index(dictionary_file, postings_file_path,
+        endpoints = endpoints)
+    # Only the first line of the query file is read.
+    with open(query_file, mode="r", encoding="utf8") as qf:
+        line = qf.readline()
+    tracing.start_trace(line)
+    final_result = run_query_line(line, dictionary, doc_length_table, postings_reader, top_k)
+    tracing.finish_trace(len(final_result))
+    close_index(dictionary, postings_reader)
+
+    write_to_output(final_result, output_file_of_results)
+
+# Runs every line of query_file as a query and writes one line of results per query
+# into output_file_of_results. The index is only loaded once for all queries.
+# If cache_bytes is given, decoded posting lists are shared between queries (see PostingsCache).
+def process_query_batch(dictionary_file, postings_file_path, query_file, output_file_of_results, top_k = None,
+    cache_bytes = None, endpoints = None):
+    (dictionary, doc_length_table, postings_reader) = load_index(dictionary_file, postings_file_path, cache_bytes,
+        endpoints)
+    with open(query_file, mode="r", encoding="utf8") as qf, open(output_file_of_results, mode="w") as of:
+        for line in qf:
+            of.write(answer_query_line(line, dictionary, doc_length_table, postings_reader, top_k) + "\n")
+    close_index(dictionary, postings_reader)
+
+# Loads the index and answers queries, one query per line, until the input ends.
+# The index is loaded again when documents are added, deleted or compacted by
+# index.py (see ServedIndex).
+# If port is "-", queries are read from stdin and results are written to stdout.
+# Otherwise queries are answered over TCP connections to localhost:port, each
+# connection being served by a thread of its own.
+# If cache_bytes is given, decoded posting lists are shared between queries (see PostingsCache).
+# If shard is given, only that shard of a sharded index is loaded, and the queries
+# are requests of the shard workers of a sharded index (see answer_shard_request).
+def serve_queries(dictionary_file, postings_file_path, port, top_k = None, cache_bytes = None, shard = None,
+    endpoints = None):
+    answer = answer_query_line
+    if shard is not None:
+        served_index = ServedIndex(dictionary_file, load_shard, postings_file_path, shard, cache_bytes)
+        answer = answer_shard_request
+    else:
+        served_index = ServedIndex(dictionary_file, load_index, postings_file_path, cache_bytes, endpoints)
+    index = served_index.get_index()
+    # Loads WordNet before the first query, instead of in the middle of one.
+    if SHARDS not in index[0] and index[0][SYNONYMS] is None:
+        wn.ensure_loaded()
+    if port == "-":
+        for line in sys.stdin:
+            print(answer_or_report(answer, line, served_index.get_index(), top_k), flush=True)
+        served_index.close()
+        return
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", int(port)), QueryHandler)
+    server.daemon_threads = True
+    server.served_index = served_index
+    server.answer = answer
+    server.top_k = top_k
+    print("serving queries on 127.0.0.1:" + str(server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    served_index.close()
+
+# The index of the query server. The manifest of the segments (see segments.py) is
+# checked before every query, and if index.py has replaced it, the index is loaded
+# again with load and its arguments, so the query sees the added, deleted and
+# compacted documents. Without segments, the index is loaded once.
+# An index that is replaced is not closed, since queries of other connections may
+# still run on it. The index holds no reference cycle (see load_index), so its files
+# are closed by reference counting as soon as the last of those queries returns. The
+# files of segments that compaction removes meanwhile stay readable until then.
+class ServedIndex:
+    def __init__(self, dictionary_file, load, *arguments):
+        self.dictionary_file = dictionary_file
+        self.load = load
+        self.arguments = arguments
+        self.lock = threading.Lock()
+        self.manifest_version = get_manifest_version(dictionary_file)
+        self.index = load(dictionary_file, *arguments)
+
+    # Returns the (dictionary, doc_length_table, postings_reader) of the current index.
+    def get_index(self):
+        with self.lock:
+            manifest_version = get_manifest_version(self.dictionary_file)
+            if manifest_version != self.manifest_version:
+                self.index = self.load(self.dictionary_file, *self.arguments)
+                self.manifest_version = manifest_version
+            return self.index
+
+    def close(self):
+        close_index(self.index[0], self.index[2])
+
+# Answers the queries sent over one connection of the query server.
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            answer = answer_or_report(self.server.answer, line.decode("utf8"), self.server.served_index.get_index(),
+                self.server.top_k)
+            self.wfile.write((answer + "\n").encode("utf8"))
+
+# Answers the query held by line with answer, the answer function of the server.
+# A query that fails is answered with an empty line, so the server keeps running, or,
+# if it is a shard request, with an error line (see ShardWorker in shards.py), so the
+# coordinator does not take it for a query without results.
+def answer_or_report(answer, line, index, top_k):
+    try:
+        return answer(line, *index, top_k)
+    except Exception as e:
+        print("query failed: " + repr(e), file=sys.stderr)
+        if answer is answer_shard_request:
+            return get_shard_error_line(e)
+        return empty_string
+
+# Loads the dictionary and opens the postings file, behind a PostingsCache of
+# cache_bytes if it is given.
+# If documents were added to or deleted from the index (see segments.py), every live
+# segment is loaded, with its tombstones, and the cache budget is split between them.
+# The dictionary, doc length table and postings reader of the first segment are
+# returned, and its dictionary[SEGMENTS] holds the (dictionary, doc_length_table,
+# postings_reader) of the other segments (see get_segments). The first segment is not
+# in that list, so the index holds no reference cycle, and its files are closed as
+# soon as it is dropped.
+# If the index is sharded (see shards.py), no shard is loaded here: a worker process
+# is started for every shard, with an equal part of the cache budget, or, if the
+# ports of shard servers are given in endpoints, one for every shard in order, they
+# are connected to. dictionary[SHARDS] then holds the workers.
+def load_index(dictionary_file, postings_file_path, cache_bytes = None, endpoints = None):
+    shard_count = read_shard_count(dictionary_file)
+    if shard_count > 0:
+        if endpoints is not None:
+            if len(endpoints) != shard_count:
+                raise ValueError("the index has " + str(shard_count) + " shards, but " + str(len(endpoints)) +
+                    " shard servers are given")
+            workers = [connect_shard(port) for port in endpoints]
+        else:
+            workers = [start_shard_process(dictionary_file, postings_file_path, number,
+                cache_bytes // shard_count if cache_bytes is not None else None) for number in range(shard_count)]
+        return ({SHARDS: workers}, None, None)
+    manifest = read_manifest(dictionary_file)
+    segments = []
+    for number in manifest["segments"]:
+        (segment_dictionary_file, segment_postings_file) = get_segment_files(dictionary_file, postings_file_path, number)
+        (dictionary, doc_length_table) = read_dictionary_to_memory(segment_dictionary_file)
+        postings_reader = PostingsReader(segment_postings_file)
+        if cache_bytes is not None:
+            postings_reader = PostingsCache(postings_reader, cache_bytes // len(manifest["segments"]))
+        # The tombstones of the manifest are filenames.
+        dictionary[TOMBSTONES] = {get_doc_id(dictionary[FILENAMES], filename)
+            for filename in manifest["tombstones"][number]}
+        segments.append((dictionary, doc_length_table, postings_reader))
+
+    if len(segments) > 1 or segments[0][0][TOMBSTONES]:
+        # idf is computed over the live documents of all segments.
+        collection_size = sum(len(doc_length_table) - len(dictionary[TOMBSTONES])
+            for (dictionary, doc_length_table, postings_reader) in segments)
+        for (dictionary, doc_length_table, postings_reader) in segments:
+            dictionary[COLLECTION_SIZE] = collection_size
+        segments[0][0][SEGMENTS] = segments[1:]
+    return segments[0]
+
+# Returns the (dictionary, doc_length_table, postings_reader) of every live segment
+# of the index loaded by load_index, starting with the given first segment.
+def get_segments(dictionary, doc_length_table, postings_reader):
+    return [(dictionary, doc_length_table, postings_reader)] + dictionary.get(SEGMENTS, [])
+
+# Closes the index. The counters of the postings cache, if any, are printed to stderr.
+def close_index(dictionary, postings_reader):
+    if SHARDS in dictionary:
+        for worker in dictionary[SHARDS]:
+            worker.close()
+        return
+    if GLOBAL_LEXICON in dictionary:
+        dictionary[GLOBAL_LEXICON].close()
+    for (dictionary, doc_length_table, postings_reader) in get_segments(dictionary, None, postings_reader):
+        if isinstance(postings_reader, PostingsCache):
+            stats = postings_reader.get_stats()
+            print("postings cache: " + ", ".join(name + " " + str(value) for (name, value) in stats.items()),
+                file=sys.stderr)
+        postings_reader.close()
+        dictionary[CONTENT_INDEX].close()
+        dictionary[FIELDS].close()
+
+# Runs the query held by line and returns its results as a line of doc IDs.
+def answer_query_line(line, dictionary, doc_length_table, postings_reader, top_k = None):
+    tracing.start_trace(line)
+    results = run_query_line(line, dictionary, doc_length_table, postings_reader, top_k)
+    tracing.finish_trace(len(results))
+    return format_results(results)
+
+# Runs the query held by line and returns the (filename, score) tuples of the results,
+# sorted by score. The query is parsed here, or, if the index is sharded, by the
+# shard workers it is sent to.
+def run_query_line(line, dictionary, doc_length_table, postings_reader, top_k = None):
+    if SHARDS in dictionary:
+        return run_query_on_shards(line, dictionary[SHARDS], top_k)
+    phrases, query, notstemmed_query = query_from_line(line)
+    tracing.end_stage("parse_query")
+    return run_query(phrases, query, notstemmed_query, dictionary, doc_length_table, postings_reader, top_k)
+
+# Held while a query is sent to the shard workers and their results are received.
+shards_lock = threading.Lock()
+
+# Runs the query held by line on every shard of a sharded index at once, and merges
+# their results like run_query_on_segments merges the results of segments, so the
+# results are the same as the ones of an index built without shards.
+# The workers answer one query at a time, so the queries of several connections of
+# the query server wait for each other here.
+# Raises RuntimeError if the query failed on a shard, once the answers of all the
+# workers are read. If a worker cannot be sent the query or its answer cannot be
+# read, answers can be left unread on the other workers, so all of them are
+# restarted before the error is raised, and the next query gets fresh answers.
+# The trace of the query only has the scatter_gather and merge_shards stages: the
+# other stages run in the shard workers, which do not trace them.
+def run_query_on_shards(line, workers, top_k):
+    results = []
+    errors = []
+    with shards_lock:
+        try:
+            for worker in workers:
+                worker.send(line, top_k)
+            for worker in workers:
+                try:
+                    results.extend(worker.receive())
+                except RuntimeError as e:
+                    errors.append(e)
+        except (OSError, ValueError):
+            # A worker that cannot be restarted stays closed, so the next query fails
+            # on it and restarts all the workers again.
+            for worker in workers:
+                try:
+                    worker.restart()
+                except OSError as e:
+                    print("shard worker restart failed: " + repr(e), file=sys.stderr)
+            raise
+    if errors:
+        raise errors[0]
+    tracing.end_stage("scatter_gather")
+    results.sort(key=itemgetter(0))
+    if top_k is not None:
+        results = heapq.nlargest(top_k, results, key=itemgetter(1))
+    else:
+        results = sorted(results, key=itemgetter(1), reverse=True)
+    tracing.end_stage("merge_shards")
+    return results
+
+# Loads shard number of the sharded index in dictionary_file (see shards.py), for a
+# shard worker. The shard is scored with the collection size of the whole index, the
+# document frequencies of its lexicon (see run_query) and its synonym table.
+def load_shard(dictionary_file, postings_file_path, number, cache_bytes = None):
+    with open(dictionary_file, mode="rb") as df:
+        settings = pickle.load(df)[0]
+    (shard_dictionary_file, shard_postings_file) = get_shard_files(dictionary_file, postings_file_path, number)
+    (dictionary, doc_length_table) = read_dictionary_to_memory(shard_dictionary_file)
+    postings_reader = PostingsReader(shard_postings_file)
+    if cache_bytes is not None:
+        postings_reader = PostingsCache(postings_reader, cache_bytes)
+    dictionary[COLLECTION_SIZE] = settings[COLLECTION_SIZE]
+    dictionary[GLOBAL_LEXICON] = Lexicon(get_lexicon_path(dictionary_file))
+    if os.path.exists(get_synonyms_path(dictionary_file)):
+        dictionary[SYNONYMS] = SynonymTable(get_synonyms_path(dictionary_file))
+    return (dictionary, doc_length_table, postings_reader)
+
+# Answers a request of the coordinator of a sharded index (see ShardWorker in
+# shards.py): the top K of the coordinator and a query, separated by a tab.
+# Returns the filenames and the exact scores of the results on the shard, as a line.
+# The top_k of the shard server is not used.
+def answer_shard_request(line, dictionary, doc_length_table, postings_reader, top_k = None):
+    (top_k, line) = line.split("\t", 1)
+    phrases, query, notstemmed_query = query_from_line(line)
+    results = run_query(phrases, query, notstemmed_query, dictionary, doc_length_table, postings_reader,
+        int(top_k) or None)
+    return ' '.join(str(filename) + ' ' + repr(score) for (filename, score) in results)
+
+# Runs a parsed query and returns the (filename, score) tuples of the results, sorted by score.
+# If top_k is given, only the top_k results are returned.
+def run_query(phrases, query, notstemmed_query, dictionary, doc_length_table, postings_reader, top_k = None):
+    if SEGMENTS in dictionary:
+        return run_query_on_segments(phrases, query, notstemmed_query,
+            get_segments(dictionary, doc_length_table, postings_reader), top_k)
+    if GLOBAL_LEXICON in dictionary:
+        return run_shard_query(phrases, query, notstemmed_query, dictionary, doc_length_table, postings_reader, top_k)
+    return run_segment_query(phrases, query, notstemmed_query, dictionary, doc_length_table, postings_reader, top_k)
+
+# Runs a parsed query on every live segment of the index and merges the results.
+# All segments are scored with the collection size and the document frequencies of
+# the live documents of the whole index, so every document gets the same score as in
+# an index built from all of them at once. A document is live in one segment only,
+# and results with the same score are ordered by filename, as in a single index.
+def run_query_on_segments(phrases, query, notstemmed_query, segments, top_k):
+    if len(query) == 0:
+        return []
+    expansion_rounds = get_expansion_rounds(phrases, notstemmed_query, segments[0][0][SYNONYMS])
+    tracing.end_stage("get_expansion_rounds")
+    (terms, positional_terms) = get_query_terms(query, expansion_rounds)
+    doc_frequencies = get_doc_frequencies(terms, segments)
+    tracing.end_stage("get_doc_frequencies")
+    results = []
+    for (dictionary, doc_length_table, postings_reader) in segments:
+        results.extend(run_segment_query(phrases, query, notstemmed_query, dictionary, doc_length_table,
+            postings_reader, top_k, expansion_rounds, doc_frequencies))
+    results.sort(key=itemgetter(0))
+    if top_k is not None:
+        results = heapq.nlargest(top_k, results, key=itemgetter(1))
+    else:
+        results = sorted(results, key=itemgetter(1), reverse=True)
+    tracing.end_stage("merge_segments")
+    return results
+
+# Runs a parsed query on one shard of a sharded index, with the document frequencies
+# of the whole index, from its lexicon in dictionary[GLOBAL_LEXICON].
+def run_shard_query(phrases, query, notstemmed_query, dictionary, doc_length_table, postings_reader, top_k):
+    if len(query) == 0:
+        return []
+    expansion_rounds = get_expansion_rounds(phrases, notstemmed_query, dictionary[SYNONYMS])
+    tracing.end_stage("get_expansion_rounds")
+    (terms, positional_terms) = get_query_terms(query, expansion_rounds)
+    doc_frequencies = dict()
+    for term in terms:
+        node = dictionary[GLOBAL_LEXICON].get(term)
+        doc_frequencies[term] = node.get_doc_frequency() if node is not None else 0
+    tracing.end_stage("get_doc_frequencies")
+    return run_segment_query(phrases, query, notstemmed_query, dictionary, doc_length_table, postings_reader,
+        top_k, expansion_rounds, doc_frequencies)
+
+# Returns the number of live documents of every term in all segments: the document
+# frequencies of the lexicons, without the tombstoned documents.
+def get_doc_frequencies(terms, segments):
+    doc_frequencies = {term: 0 for term in terms}
+    for (dictionary, doc_length_table, postings_reader) in segments:
+        tombstones = sorted(dictionary[TOMBSTONES])
+        for term in terms:
+            node = dictionary[CONTENT_INDEX].get(term)
+            if node is None:
+                continue
+            doc_frequencies[term] += node.get_doc_frequency()
+            if tombstones:
+                doc_frequencies[term] -= count_postings(postings_reader.get_postings(node), tombstones)
+    return doc_frequencies
+
+# Returns how many of the sorted doc_ids are in the posting list.
+def count_postings(postings, doc_ids):
+    count = 0
+    i = 0
+    for doc_id in doc_ids:
+        i = postings.seek(doc_id, i)
+        if i == len(postings):
+            break
+        if postings.doc_id(i) == doc_id:
+            count += 1
+    return count
+
+# Runs a parsed query on one segment of the index.
+# Returns the (filename, score) tuples of the results, sorted by score.
+# If top_k is given, only the top_k results are returned, and documents that cannot
+# reach them are not scored further (see remove_hopeless_docs).
+# expansion_rounds and doc_frequencies are given when the index has several segments
+# (see run_query_on_segments).
 # The score for a document is determined by four aspects:
 # tf-idf of the content,
 # query expansion,
 # distance between every two query phrases in the content of a document,
 # and fields info.
-def process_queries(dictionary_file, postings_file_path, query_file, output_file_of_results):
-    (dictionary, doc_length_table) = read_dictionary_to_memory(dictionary_file)
-    phrases, query, notstemmed_query = parse_query(query_file)
-
+def run_segment_query(phrases, query, notstemmed_query, dictionary, doc_length_table, postings_reader, top_k = None,
+    expansion_rounds = None, doc_frequencies = None):
+    if len(query) == 0:
+        return []
+    if expansion_rounds is None:
+        expansion_rounds = get_expansion_rounds(phrases, notstemmed_query, dictionary[SYNONYMS])
+        tracing.end_stage("get_expansion_rounds")
+    query_postings = plan_query(query, expansion_rounds, dictionary, postings_reader, doc_frequencies)
+    tracing.end_stage("plan_query")
     (score_dict, position_list_arr) = get_query_result(query, dictionary, doc_length_table,
-        postings_file_path, True, True)
-    update_score_by_query_expansion(score_dict, phrases, notstemmed_query, dictionary, doc_length_table, postings_file_path)
+        query_postings, True, True)
+    tracing.end_stage("get_query_result")
+    if dictionary.get(TOMBSTONES):
+        # Deleted documents are removed before anything else uses the candidates.
+        score_dict = {doc_id: score for (doc_id, score) in score_dict.items() if doc_id not in dictionary[TOMBSTONES]}
+        tracing.add_candidates("tombstones", len(score_dict))
+        tracing.end_stage("tombstones")
+    if top_k is not None:
+        score_dict = remove_hopeless_docs(score_dict, expansion_rounds, len(query), top_k, dictionary,
+            doc_length_table, query_postings)
+        tracing.add_candidates("remove_hopeless_docs", len(score_dict))
+        tracing.end_stage("remove_hopeless_docs")
+    update_score_by_query_expansion(score_dict, expansion_rounds, dictionary, doc_length_table, query_postings)
+    tracing.end_stage("update_score_by_query_expansion")
     normalized_score = get_normalized_score(score_dict, doc_length_table)
+    tracing.end_stage("get_normalized_score")
     update_score_by_position(normalized_score, position_list_arr)
+    tracing.end_stage("update_score_by_position")
     update_score_by_fields(normalized_score, dictionary)
-    final_result = sorted(normalized_score.items(), key=itemgetter(1), reverse=True)
+    tracing.end_stage("update_score_by_fields")
+    if top_k is not None:
+        # Same as sorted(...)[:top_k], but only keeps a heap of top_k results.
+        results = heapq.nlargest(top_k, normalized_score.items(), key=itemgetter(1))
+    else:
+        results = sorted(normalized_score.items(), key=itemgetter(1), reverse=True)
+    # The internal doc IDs are translated back to filenames only for the results.
+    filenames = dictionary[FILENAMES]
+    results = [(filenames[doc_id], score) for (doc_id, score) in results]
+    tracing.end_stage("sort")
+    return results
 
-    write_to_output(final_result, output_file_of_results)
+# Removes the documents that cannot be in the top_k results, before the expansion
+# rounds and the positional scoring are run on them (MaxScore-style pruning).
+# At this point the tf-idf score of the query phrases is known. The final score
+# of a document is at least that score normalized, plus its field score. It is at
+# most that score normalized, plus the upper bound of the expansion rounds (from
+# the max weight of every synonym, stored in the lexicon), times the largest
+# positional boost, plus its field score.
+# A document whose upper bound is below the top_k-th largest lower bound cannot
+# reach the top_k results, and the scores of the remaining documents do not change.
+# If the index has impacts, the bounds of the expansion rounds are computed for every
+# document (see remove_hopeless_docs_by_impacts).
+def remove_hopeless_docs(score_dict, expansion_rounds, phrase_count, top_k, dictionary, doc_length_table, query_postings):
+    if len(score_dict) <= top_k:
+        return score_dict
+    pair_count = phrase_count * (phrase_count - 1) // 2
+    position_boost = sentence_boost ** pair_count
+    if dictionary.get(IMPACTS):
+        return remove_hopeless_docs_by_impacts(score_dict, expansion_rounds, position_boost, top_k, dictionary,
+            doc_length_table, query_postings)
+    expansion_bound = get_expansion_upper_bound(expansion_rounds, dictionary, query_postings)
+
+    lower_bound = dict()
+    upper_bound = dict()
+    for (doc_id, score) in score_dict.items():
+        normalized = score / doc_length_table[doc_id]
+        lower_bound[doc_id] = normalized
+        upper_bound[doc_id] = (normalized + expansion_bound) * position_boost
+    update_score_by_fields(lower_bound, dictionary)
+    update_score_by_fields(upper_bound, dictionary)
+
+    threshold = heapq.nlargest(top_k, lower_bound.values())[-1]
+    # The bounds are relaxed a little, so that rounding errors cannot remove a document.
+    threshold -= abs(threshold) * 1e-9
+    return {doc_id: score for (doc_id, score) in score_dict.items() if upper_bound[doc_id] >= threshold}
+
+# Same as remove_hopeless_docs, with bounds of the expansion rounds for every document,
+# computed score-at-a-time from the impact-ordered posting lists of the synonyms.
+# The groups of all synonyms are read from the highest contribution down, and the
+# contribution of a group, the query weight times its impact, is added to the
+# bounds of the candidates in it. The expansion score of a document is at most what
+# its groups added, plus the contributions of the next group of every synonym; for
+# the words of OR rounds, it is at least the lower end of its groups' impacts.
+# Reading stops once only top_k candidates can still reach the top_k results, so the
+# groups of low impacts, which hold most of the postings, are often never decoded.
+def remove_hopeless_docs_by_impacts(score_dict, expansion_rounds, position_boost, top_k, dictionary,
+    doc_length_table, query_postings):
+    field_score = {doc_id: 0 for doc_id in score_dict}
+    update_score_by_fields(field_score, dictionary)
+    lower_bound = dict()
+    upper_bound = dict()
+    for (doc_id, score) in score_dict.items():
+        lower_bound[doc_id] = upper_bound[doc_id] = score / doc_length_table[doc_id]
+
+    heap = get_impact_streams(expansion_rounds, dictionary, query_postings)
+    remove_impossible_docs(lower_bound, upper_bound, heap, position_boost, top_k, field_score)
+    read_postings = 0
+    while heap and len(upper_bound) > top_k:
+        (negative_contribution, number, impact, doc_ids, query_weight, remove_incomplete, groups) = heapq.heappop(heap)
+        contribution = query_weight * impact
+        lower_contribution = query_weight * (impact - 1)
+        for doc_id in doc_ids:
+            if doc_id in upper_bound:
+                upper_bound[doc_id] += contribution
+                if not remove_incomplete:
+                    lower_bound[doc_id] += lower_contribution
+        push_next_group(heap, number, query_weight, remove_incomplete, groups)
+        # The bounds are checked after reading about as many postings as there are
+        # candidates left, so the checks cost as much as the reading.
+        read_postings += len(doc_ids)
+        if read_postings >= len(upper_bound) or not heap:
+            remove_impossible_docs(lower_bound, upper_bound, heap, position_boost, top_k, field_score)
+            read_postings = 0
+    return {doc_id: score for (doc_id, score) in score_dict.items() if doc_id in upper_bound}
+
+# Returns a heap holding the first group of the impact-ordered posting list of every
+# term of the expansion rounds (see push_next_group).
+def get_impact_streams(expansion_rounds, dictionary, query_postings):
+    collection_size = dictionary[COLLECTION_SIZE]
+    heap = []
+    for (synonyms, weight, remove_incomplete) in expansion_rounds:
+        for (term, term_info) in synonyms.items():
+            node = query_postings.get_node(term)
+            if node is None:
+                continue
+            query_weight = calculate_query_weight(term_info[tf], node.get_doc_frequency(), collection_size)
+            push_next_group(heap, len(heap), weight * query_weight / IMPACT_LEVELS, remove_incomplete,
+                query_postings.get_impacts(node))
+    return heap
+
+# Pushes the next group of an impact-ordered posting list onto the heap, if it has one
+# left. Entries are ordered by their contribution, the highest first.
+def push_next_group(heap, number, query_weight, remove_incomplete, groups):
+    group = next(groups, None)
+    if group is not None:
+        (impact, doc_ids) = group
+        heapq.heappush(heap, (-query_weight * impact, number, impact, doc_ids, query_weight, remove_incomplete, groups))
+
+# Removes the candidates whose upper bound is below the top_k-th largest lower bound
+# from lower_bound and upper_bound, given the heap of the groups that are not read yet.
+def remove_impossible_docs(lower_bound, upper_bound, heap, position_boost, top_k, field_score):
+    remaining = sum(-entry[0] for entry in heap)
+    threshold = heapq.nlargest(top_k, (bound + field_score[doc_id] for (doc_id, bound) in lower_bound.items()))[-1]
+    # The bounds are relaxed a little, so that rounding errors cannot remove a document.
+    threshold -= abs(threshold) * 1e-9
+    for (doc_id, bound) in list(upper_bound.items()):
+        if (bound + remaining) * position_boost + field_score[doc_id] < threshold:
+            del upper_bound[doc_id]
+            del lower_bound[doc_id]
+
+# Returns the largest score the expansion rounds can add to the normalized score
+# of a document.
+def get_expansion_upper_bound(expansion_rounds, dictionary, query_postings):
+    collection_size = dictionary[COLLECTION_SIZE]
+    expansion_bound = 0
+    for (synonyms, weight, remove_incomplete) in expansion_rounds:
+        for (term, term_info) in synonyms.items():
+            node = query_postings.get_node(term)
+            if node is None:
+                continue
+            query_weight = calculate_query_weight(term_info[tf], node.get_doc_frequency(), collection_size)
+            expansion_bound += weight * query_weight * node.get_max_weight()
+    return expansion_bound
 
 # Calculates the results of each phrase in the passed query and intersects them to get the result
 # of the query.
-def get_query_result(query, dictionary, doc_length_table, postings_file_path,
+# If remove_incomplete is set, only documents that match every phrase are kept, with
+# the score of the first phrase (see get_conjunctive_result). Otherwise the words of
+# every phrase are connected by OR.
+def get_query_result(query, dictionary, doc_length_table, query_postings,
     remove_incomplete, check_position, previous_result = None):
-    score_dict = None
-    position_list_arr = []
-    with open(postings_file_path, 'rb') as postings_file:
+    if remove_incomplete:
+        (score_dict, position_list_arr) = get_conjunctive_result(query, dictionary, query_postings, previous_result)
+    else:
+        score_dict = None
+        position_list_arr = []
+        # The candidates are sorted once for all the terms of the query.
+        sorted_candidates = sorted(previous_result) if previous_result is not None else None
         for phrase in query:
-            (score, position_list) = calculate_cosine_score(dictionary, doc_length_table, postings_file,
-                phrase, remove_incomplete, CONTENT_INDEX, previous_result)
+            score = calculate_cosine_score(dictionary, query_postings, phrase, previous_result, sorted_candidates)
             if score_dict is None:
                 score_dict = score
             else:
                 score_dict = intersect_dicts(score_dict, score)
-            if check_position:
-                position_list_arr.append(position_list)
 
     if check_position:
         return score_dict, position_list_arr
 
     return score_dict
 
+# Calculates the results of the phrases connected by AND.
+# The posting lists of all words of all phrases (and of their biwords, if the index
+# has them) are intersected first, from the rarest
+# word to the most common one. Every candidate is looked up in the next list by
+# galloping over its block index, so only the blocks that can hold candidates are
+# decoded. Then the positions of the remaining candidates are checked phrase by
+# phrase, and they are scored with the words of the first phrase.
+# Returns the score dictionary and the position list of every phrase.
+def get_conjunctive_result(query, dictionary, query_postings, previous_result):
+    collection_size = dictionary[COLLECTION_SIZE]
+    phrases = [phrase for phrase in query if len(phrase) > 0]
+    if len(phrases) == 0:
+        return dict(), []
+
+    postings_cache = dict()
+    for phrase in phrases:
+        for term in phrase:
+            if term in postings_cache:
+                continue
+            node = query_postings.get_node(term)
+            if node is None:
+                # No document can match a phrase with a word that is not indexed.
+                return dict(), []
+            postings_cache[term] = (node, query_postings.get_postings(node))
+    if dictionary.get(BIWORDS):
+        # The biwords of the phrases are intersected with the words too, which leaves
+        # out most documents that do not hold the phrases before their positions are
+        # checked. Biwords that are not indexed are skipped.
+        for phrase in phrases:
+            biword = get_phrase_biword(phrase)
+            if biword is None or biword in postings_cache:
+                continue
+            node = query_postings.get_node(biword)
+            if node is not None:
+                postings_cache[biword] = (node, query_postings.get_postings(node))
+
+    terms = sorted(postings_cache, key=lambda term: postings_cache[term][0].get_doc_frequency())
+    term_numbers = {term: k for (k, term) in enumerate(terms)}
+    candidates = intersect_postings([postings_cache[term][1] for term in terms], previous_result)
+    tracing.add_candidates("intersect_postings " + " ".join(terms), len(candidates))
+
+    position_list_arr = []
+    for phrase in phrases:
+        (candidates, position_list) = get_phrase_matches(phrase, candidates, postings_cache, term_numbers)
+        position_list_arr.append(position_list)
+        tracing.add_candidates("get_phrase_matches " + " ".join(phrase), len(candidates))
+
+    query_weights = dict()
+    for (term, query_info) in phrases[0].items():
+        query_df = postings_cache[term][0].get_doc_frequency()
+        query_weights[term] = calculate_query_weight(query_info[tf], query_df, collection_size)
+    if scoring.vectorized and len(candidates) >= scoring.vectorized_min_postings:
+        scores = scoring.get_conjunctive_scores([indexes for (doc_id, indexes) in candidates],
+            [(postings_cache[term][1], query_weights[term], term_numbers[term]) for term in phrases[0]])
+        return dict(zip([doc_id for (doc_id, indexes) in candidates], scores)), position_list_arr
+    score_dict = dict()
+    for (doc_id, indexes) in candidates:
+        score = 0
+        for term in phrases[0]:
+            doc_tf = postings_cache[term][1].tfs[indexes[term_numbers[term]]]
+            score += query_weights[term] * calculate_log_tf(doc_tf)
+        score_dict[doc_id] = score
+    return score_dict, position_list_arr
+
+# Intersects posting lists, sorted from the shortest to the longest.
+# The doc IDs of the shortest list (or previous_result, if it is smaller) are looked up
+# in every list with Postings.seek.
+# Returns (doc ID, [index of the doc ID in every list]) for every doc ID that is in all
+# the lists, and in previous_result if it is given.
+def intersect_postings(postings_lists, previous_result):
+    shortest = postings_lists[0]
+    if previous_result is not None and len(previous_result) < len(shortest):
+        doc_ids = sorted(previous_result)
+    else:
+        doc_ids = shortest.doc_ids
+        if previous_result is not None:
+            doc_ids = [doc_id for doc_id in doc_ids if doc_id in previous_result]
+
+    candidates = [(doc_id, []) for doc_id in doc_ids]
+    for postings in postings_lists:
+        matched = []
+        i = 0
+        for (doc_id, indexes) in candidates:
+            i = postings.seek(doc_id, i)
+            if i == len(postings):
+                break
+            if postings.doc_id(i) == doc_id:
+                indexes.append(i)
+                matched.append((doc_id, indexes))
+        candidates = matched
+    return candidates
+
 # To get synonyms of the original query, here we are finding the synonyms of
 # the original query phrases and synonyms for those terms appeared in the
 # not-stemmed query, by using wordnet.
@@ -78,25 +930,38 @@ def get_query_result(query, dictionary, doc_length_table, postings_file_path,
 # While for a term, we just consider them as "OR" relations, and perform
 # the standard tf-idf search.
 # Therefore, there are four difference cases in total.
-def update_score_by_query_expansion(result, phrases, notstemmed_query, dictionary, doc_length_table, postings_file_path):
-    new_phrase_query = get_synonyms_for_phrase(phrases)
+# Each case is returned as rounds of (synonyms, weight, remove_incomplete), which are
+# applied to the result by update_score_by_query_expansion.
+def get_expansion_rounds(phrases, notstemmed_query, synonym_table):
+    expansion_rounds = []
+    new_phrase_query = get_synonyms_for_phrase(phrases, synonym_table)
     for phrase in new_phrase_query[PHRASE]:
-        update_query_result_for_synonyms(result, phrase, synonyms_phrase_weight, True, dictionary, doc_length_table, postings_file_path)
-    update_query_result_for_synonyms(result, new_phrase_query[WORD], synonyms_phrase_weight, False, dictionary, doc_length_table, postings_file_path)
+        expansion_rounds.append((phrase, synonyms_phrase_weight, True))
+    expansion_rounds.append((new_phrase_query[WORD], synonyms_phrase_weight, False))
 
-    new_word_query = get_synonyms_for_query(notstemmed_query)
+    new_word_query = get_synonyms_for_query(notstemmed_query, synonym_table)
     for phrase in new_word_query[PHRASE]:
-         update_query_result_for_synonyms(result, phrase, synonyms_word_weight, True, dictionary, doc_length_table, postings_file_path)
-    update_query_result_for_synonyms(result, new_word_query[WORD], synonyms_word_weight, False, dictionary, doc_length_table, postings_file_path)
+        expansion_rounds.append((phrase, synonyms_word_weight, True))
+    expansion_rounds.append((new_word_query[WORD], synonyms_word_weight, False))
+    return expansion_rounds
+
+def update_score_by_query_expansion(result, expansion_rounds, dictionary, doc_length_table, query_postings):
+    for (synonyms, weight, remove_incomplete) in expansion_rounds:
+        if tracing.enabled:
+            tracing.add_expansion_terms([term for term in synonyms if query_postings.get_node(term) is not None],
+                weight, remove_incomplete)
+        update_query_result_for_synonyms(result, synonyms, weight, remove_incomplete, dictionary, doc_length_table, query_postings)
 
 # Adds score of querying those synonyms multplied by weight to the previous_result.
-def update_query_result_for_synonyms(previous_result, synonyms, weight, remove_incomplete, dictionary, doc_length_table, postings_file_path):
-    synonyms_result = get_query_result([synonyms], dictionary, doc_length_table, postings_file_path, remove_incomplete, False, previous_result)
+def update_query_result_for_synonyms(previous_result, synonyms, weight, remove_incomplete, dictionary, doc_length_table, query_postings):
+    synonyms_result = get_query_result([synonyms], dictionary, doc_length_table, query_postings, remove_incomplete, False, previous_result)
     for result in synonyms_result:
         previous_result[result] += synonyms_result[result] * weight
 
 # Normalizes the score for each document.
 def get_normalized_score(score_dictionary, doc_length_table):
+    if scoring.vectorized and len(score_dictionary) >= scoring.vectorized_min_postings:
+        return scoring.get_normalized_scores(score_dictionary, doc_length_table)
     for (doc_id, score) in score_dictionary.items():
         score_dictionary[doc_id] = score / doc_length_table[doc_id]
     return score_dictionary
@@ -107,15 +972,25 @@ def get_normalized_score(score_dictionary, doc_length_table):
 # Here we set two thresholds: distance within 10 words (same sentence),
 # and distance within 50 words (same paragraph).
 def update_score_by_position(score_dict, position_list_arr):
+    if len(position_list_arr) > 1:
+        position_list_arr = [get_position_list_for_docs(position_list, score_dict) for position_list in position_list_arr]
     for i in range(0, len(position_list_arr) - 1):
         for j in range(i + 1, len(position_list_arr)):
             answer_100 = get_positional_intersect(position_list_arr[i], position_list_arr[j], 100)
             answer_20 = get_positional_intersect(position_list_arr[i], position_list_arr[j], 20)
             for doc in answer_100:
                 if doc in score_dict and doc in answer_20:
-                    score_dict[doc] *= 1.5
+                    score_dict[doc] *= sentence_boost
                 elif doc in score_dict:
-                    score_dict[doc] *= 1.2
+                    score_dict[doc] *= paragraph_boost
+
+# Returns the (doc ID, [positions...]) tuples of the position list for the given documents.
+# The position list of a single-word phrase is its posting list, and only the positions
+# of the given documents are decoded from it.
+def get_position_list_for_docs(position_list, docs):
+    if isinstance(position_list, Postings):
+        return [(doc_id, position_list.positions(i)) for (i, doc_id) in enumerate(position_list.doc_ids) if doc_id in docs]
+    return [posting for posting in position_list if posting[0] in docs]
 
 # Updates score by those fields in the document (court and tag).
 # We rank the weight for courts: SGCA > SGHC > SG** (any case in SG) > **CA
@@ -124,36 +999,20 @@ def update_score_by_position(score_dict, position_list_arr):
 # the court is SGCA.
 # Alo, as stated in the instruction for the assignment, documents with tagged
 # are considered as landmark cases and are morelikly to be relevant.
+# The score of the fields of every document is computed by the indexer, as its static
+# prior in the field store (see fields.py), so it is only added here.
 def update_score_by_fields(normalized_score, dictionary):
-    for result in normalized_score:
-        if result not in dictionary[COURT]:
-            continue
-        court = dictionary[COURT][result]
-        if court == None:
-            continue
-        if court in courts_score:
-            normalized_score[result] += courts_score[court]
-        elif len(court) >= 2:
-            prefix = court[:2] # for exanple, `SG`
-            if prefix in courts_score:
-                normalized_score[result] += courts_score[prefix]
-            subfix = court[-2:]  # for example, `CA`
-            if subfix in courts_score:
-                normalized_score[result] += courts_score[subfix]
-        if result not in dictionary[TAG]:
-            continue
-        if dictionary[TAG][result]:
-            normalized_score[result] += tag_score
+    dictionary[FIELDS].add_priors(normalized_score)
 
 # Retunrs synonyms of phrases in a query.
-def get_synonyms_for_phrase(phrases):
+def get_synonyms_for_phrase(phrases, synonym_table):
     default_word_info = {tf: 1, POSITION: [0]}
     new_phrase_query = {PHRASE: [], WORD: dict()}
     for phrase in phrases:
         if ' ' not in phrase:
             continue
         phrase = phrase.replace(space, underscore)
-        word_synonyms, phrase_synonym = get_synonyms(phrase)
+        word_synonyms, phrase_synonym = get_synonyms(phrase, synonym_table)
         for synonym in word_synonyms:
             if synonym in new_phrase_query[WORD]:
                 word_info = new_phrase_query[WORD][synonym]
@@ -168,16 +1027,16 @@ def get_synonyms_for_phrase(phrases):
     return new_phrase_query
 
 # Returns synonyms of terms in a query.
-def get_synonyms_for_query(notstemmed_query):
+def get_synonyms_for_query(notstemmed_query, synonym_table):
     new_word_query = {PHRASE: [], WORD: dict()}
     for phrase in notstemmed_query:
         for word, word_info in phrase.items():
-            get_synonyms_for_word(word, word_info, new_word_query)
+            get_synonyms_for_word(word, word_info, new_word_query, synonym_table)
     return new_word_query
 
 # Returns synonyms of the word.
-def get_synonyms_for_word(word, word_info, new_word_query):
-    word_synonyms, phrase_synonym = get_synonyms(word)
+def get_synonyms_for_word(word, word_info, new_word_query, synonym_table):
+    word_synonyms, phrase_synonym = get_synonyms(word, synonym_table)
     for synonym in word_synonyms:
         if synonym in new_word_query[WORD]:
             word_info[tf] += new_word_query[WORD][synonym][tf]
@@ -187,23 +1046,12 @@ def get_synonyms_for_word(word, word_info, new_word_query):
             continue
         new_word_query[PHRASE].append(new_phrase)
 
-def get_synonyms(word):
-    word_synonyms = []
-    phrase_synonym = []
-    syn_set = wn.synsets(word)
-    for syn in syn_set:
-        for lemma in syn.lemma_names():
-            if lemma in word_synonyms or lemma == word:
-                continue
-            if underscore not in lemma:
-                lemma = stem_term(lemma)
-                if lemma == empty_string:
-                    continue
-                word_synonyms.append(lemma)
-            else:
-                words = lemma.split(underscore)
-                phrase_synonym.append(get_new_phrasal_query(words))
-    return word_synonyms, phrase_synonym
+# Returns the word synonyms and phrase synonyms of the word, from the synonym table
+# of the index if it has one, otherwise from WordNet.
+def get_synonyms(word, synonym_table):
+    if synonym_table is not None:
+        return synonym_table.get(word)
+    return get_wordnet_synonyms(word)
 
 # Intersects and returns the score dictionaries.
 def intersect_dicts(dict1, dict2):
@@ -214,110 +1062,143 @@ def intersect_dicts(dict1, dict2):
     return dict1
 
 # Calculates the cosine score based on the algorithm described in lecture slides.
-def calculate_cosine_score(dictionary, doc_length_table, postings_file, phrase,
-    remove_incomplete, tag, result_round_1):
+# When the scores of the candidates in result_round_1 are accumulated and the posting
+# lists are long, they are scored by scoring.get_candidate_scores.
+# sorted_candidates holds the doc IDs of result_round_1 in order, if it is given.
+def calculate_cosine_score(dictionary, query_postings, phrase, result_round_1, sorted_candidates):
     score_dictionary = dict()
     collection_size = dictionary[COLLECTION_SIZE]
-    postings_cache = dict()
 
+    weighted_postings = []
     for query_term, query_info in phrase.items():
-        if query_term not in dictionary[tag]:
+        node = query_postings.get_node(query_term)
+        if node is None:
             continue
 
-        query_df = dictionary[tag][query_term].get_doc_frequency()
+        query_df = node.get_doc_frequency()
         query_weight = calculate_query_weight(query_info["tf"], query_df, collection_size)
-        postings = find_posting_in_disk(dictionary, query_term, postings_file, tag)
-        postings_cache[query_term] = postings
-        update_score_dictionary(postings, score_dictionary, query_weight, result_round_1)
+        weighted_postings.append((query_postings.get_postings(node), query_weight))
 
-    position_list = dict()
-    if remove_incomplete:
-        score_dictionary, position_list = remove_unpositional_docs(score_dictionary, phrase, postings_cache)
+    if is_vectorized(weighted_postings, result_round_1):
+        return scoring.get_candidate_scores(sorted_candidates, weighted_postings)
+    for (postings, query_weight) in weighted_postings:
+        update_score_dictionary(postings, score_dictionary, query_weight, result_round_1, sorted_candidates)
+
+    return score_dictionary
 
-    return score_dictionary, position_list
+# Tells whether the candidates are scored with arrays rather than one posting at a
+# time: when NumPy is there, and the longest posting list is long, and not so much
+# longer than the candidates that looking every candidate up in it is cheaper.
+def is_vectorized(weighted_postings, candidates):
+    if not scoring.vectorized or candidates is None or len(weighted_postings) == 0:
+        return False
+    longest = max(len(postings) for (postings, query_weight) in weighted_postings)
+    return longest >= scoring.vectorized_min_postings and len(candidates) * scoring.seek_cost >= longest
 
-# Gets the document IDs that satisfy the positional constraints and removes the rest from the
-# passed score_dictionary.
-def remove_unpositional_docs(score_dictionary, phrase, postings_cache):
+# Keeps the candidates that satisfy the positional constraints of the phrase.
+# Every word of the phrase has to be within its distance in the phrase from the same
+# occurrence of the first word, and positions are only decoded for the candidates.
+# Returns the remaining candidates and the position list of the phrase: for every
+# matching document, the positions of the first word where the phrase matches.
+# The position list of a single-word phrase is its posting list.
+def get_phrase_matches(phrase, candidates, postings_cache, term_numbers):
     if len(phrase) < 2:
         term = next(iter(phrase))
-        return score_dictionary, postings_cache[term]
+        return candidates, postings_cache[term][1]
 
     word_pos_arr = []
     for word in phrase.items():
         for position in word[1][POSITION]:
             word_pos_arr.append((word[0], position))
     word_pos_arr.sort(key=itemgetter(1))
+    pos_diffs = [position - word_pos_arr[0][1] for (word, position) in word_pos_arr[1:]]
+    biword = get_phrase_biword(phrase)
+    if len(word_pos_arr) == 2 and biword in postings_cache:
+        # Every candidate holds the biword of a two-word phrase, so the phrase is matched
+        # with the positions of the biword alone.
+        order = 0 if word_pos_arr[0][0] < word_pos_arr[1][0] else 1
+        biword_postings = postings_cache[biword][1]
+        position_list = [(doc_id, get_biword_matches(biword_postings.positions(indexes[term_numbers[biword]]), order))
+            for (doc_id, indexes) in candidates]
+        return candidates, position_list
+
+    matched = []
+    position_list = []
+    for (doc_id, indexes) in candidates:
+        positions = [postings_cache[word][1].positions(indexes[term_numbers[word]]) for (word, position) in word_pos_arr]
+        matches = match_positions(positions[0], positions[1:], pos_diffs)
+        if matches:
+            matched.append((doc_id, indexes))
+            position_list.append((doc_id, matches))
+    return matched, position_list
+
+# Returns the biword (see get_biword) of the first two words of the phrase, or None
+# if the phrase has a single word. Only documents with the biword can hold the phrase,
+# as its second word must be next to its first word (see get_phrase_matches).
+def get_phrase_biword(phrase):
+    first_word = second_word = None
+    for (word, word_info) in phrase.items():
+        if 0 in word_info[POSITION]:
+            first_word = word
+        if 1 in word_info[POSITION]:
+            second_word = word
+    if first_word is None or second_word is None or first_word == second_word:
+        return None
+    return get_biword(first_word, second_word)
+
+# Returns the positions of the first word of a two-word phrase in a document, given
+# the positions of the biword of the phrase in it (see process_content in index.py).
+# order is 0 if the first word is the smaller of the two words, and 1 otherwise, so a
+# pair of adjacent words with order as its last bit starts with the first word.
+# These are the positions match_positions returns for the phrase.
+def get_biword_matches(biword_positions, order):
+    matches = []
+    for value in biword_positions:
+        position = value >> 1
+        if value & 1 != order:
+            position += 1
+        # The first word can be next to the second word on both sides.
+        if not matches or matches[-1] != position:
+            matches.append(position)
+    return matches
 
-    doc_id_lists = []
-
-    for i in range(1, len(word_pos_arr)):
-        word1 = word_pos_arr[0][0]
-        word2 = word_pos_arr[i][0]
-        if word1 not in postings_cache or word2 not in postings_cache:
-            return dict(), []
-        pos_diff = word_pos_arr[i][1] - word_pos_arr[0][1]
-        doc_id_lists.append(get_positional_intersect(postings_cache[word1],
-            postings_cache[word2], pos_diff))
-
-    intersected_list = intersect_lists(doc_id_lists)
-    position_list = list(intersected_list.items())
-    position_list.sort(key=itemgetter(0))
-
-    new_dict = dict()
-    for doc_id in intersected_list:
-        if doc_id in score_dictionary:
-            new_dict[doc_id] = score_dictionary[doc_id]
-    return new_dict, position_list
-
-# Intersects and returns the passed array of lists.
-def intersect_lists(doc_id_lists):
-    if len(doc_id_lists) == 0:
-        return doc_id_lists
-    lst = doc_id_lists[0]
-
-    for i in range(1, len(doc_id_lists)):
-        lst = list(set(lst) & set(doc_id_lists[i]))
-
-    return lst
-
-# Returns the document IDs that from passed postings lists where the words are
-# within pos_diff positions of each other.
-def get_positional_intersect(postings1, postings2, pos_diff):
+# Returns the positions in first_positions that have, for every k, a position in
+# other_positions[k] at most pos_diffs[k] away.
+# All lists are sorted, so each of them is walked once.
+def match_positions(first_positions, other_positions, pos_diffs):
+    matches = []
+    pointers = [0] * len(other_positions)
+    for position in first_positions:
+        for k in range(len(other_positions)):
+            positions = other_positions[k]
+            i = pointers[k]
+            while i < len(positions) and positions[i] < position - pos_diffs[k]:
+                i += 1
+            pointers[k] = i
+            if i == len(positions):
+                # Later positions of the first word are even further away.
+                return matches
+            if positions[i] > position + pos_diffs[k]:
+                break
+        else:
+            matches.append(position)
+    return matches
+
+# Returns the document IDs that from passed position lists where the words are
+# within pos_diff positions of each other, with the matching positions of the
+# first list.
+def get_positional_intersect(position_list1, position_list2, pos_diff):
     answer = dict()
-    #postings1
     i = 0
-    #postings2
     j = 0
-
-    while i < len(postings1) and j < len(postings2):
-        if postings1[i][0] == postings2[j][0]:
-
-            lst = []
-            positions1 = postings1[i][1]
-            positions2 = postings2[j][1]
-            pp1 = 0
-            pp2 = 0
-
-            while pp1 < len(positions1):
-                while pp2 < len(positions2):
-                    if abs(positions1[pp1] - positions2[pp2]) <= pos_diff:
-                        lst.append(positions2[pp2])
-                    elif positions2[pp2] > positions1[pp1]:
-                        break
-                    pp2 += 1
-
-                for element in lst:
-                    if abs(element - positions1[pp1]) <= pos_diff:
-                        doc_ID = postings1[i][0]
-                        if doc_ID not in answer:
-                            answer[doc_ID] = []
-                        answer[doc_ID].append(positions1[pp1])
-
-                pp1 += 1
+    while i < len(position_list1) and j < len(position_list2):
+        if position_list1[i][0] == position_list2[j][0]:
+            matches = match_positions(position_list1[i][1], [position_list2[j][1]], [pos_diff])
+            if matches:
+                answer[position_list1[i][0]] = matches
             i += 1
             j += 1
-        elif postings1[i][0] < postings2[j][0]:
+        elif position_list1[i][0] < position_list2[j][0]:
             i += 1
         else:
             j += 1
@@ -331,12 +1212,13 @@ def calculate_query_weight(query_tf, query_df, collection_size):
 
 # Calculates the lnc weight for for all documents in postings
 # and updates their scores.
-def update_score_dictionary(postings, score_dictionary, query_weight, result_round_1):
-    for document in postings:
-        doc_id = document[0]
+def update_score_dictionary(postings, score_dictionary, query_weight, result_round_1, sorted_candidates):
+    if result_round_1 is not None and len(result_round_1) < len(postings):
+        update_score_dictionary_for_candidates(postings, score_dictionary, query_weight, sorted_candidates)
+        return
+    for (doc_id, doc_tf) in zip(postings.doc_ids, postings.tfs):
         if result_round_1 is not None and doc_id not in result_round_1:
             continue
-        doc_tf = len(document[1])
         doc_weight = calculate_log_tf(doc_tf)
 
         if doc_id not in score_dictionary:
@@ -344,6 +1226,25 @@ def update_score_dictionary(postings, score_dictionary, query_weight, result_rou
 
         score_dictionary[doc_id] += query_weight * doc_weight
 
+# Same as update_score_dictionary, for candidates that are fewer than the documents of
+# the posting list. Every candidate is looked up in the list with Postings.seek, which
+# skips the blocks without candidates, so the cost depends on the number of candidates
+# instead of the document frequency of the term. The candidates are sorted by doc ID.
+def update_score_dictionary_for_candidates(postings, score_dictionary, query_weight, sorted_candidates):
+    i = 0
+    for doc_id in sorted_candidates:
+        i = postings.seek(doc_id, i)
+        if i == len(postings):
+            break
+        if postings.doc_id(i) != doc_id:
+            continue
+        doc_weight = calculate_log_tf(postings.tfs[i])
+
+        if doc_id not in score_dictionary:
+            score_dictionary[doc_id] = 0
+
+        score_dictionary[doc_id] += query_weight * doc_weight
+
 def write_to_output(results, output_file_of_results):
     with open(output_file_of_results, mode="w") as of:
         of.write(format_results(results))
@@ -352,11 +1253,25 @@ def format_results(results):
     return ' '.join(list(map(str, [result[0] for result in results])))
 
 def usage():
-    print ("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q query-file -o output-file-of-results")
+    print ("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q query-file -o output-file-of-results [-b] [-k K] [-c cache-bytes]")
+    print ("       " + sys.argv[0] + " -d dictionary-file -p postings-file -s port [-k K] [-c cache-bytes]")
+    print ("       [-t trace-file] [-P profile-file] [-e port,port,...] with any of the above")
+    print ("       " + sys.argv[0] + " -d dictionary-file -p postings-file -s port -x shard-number [-c cache-bytes]")
+    print ("  -b  runs every line of query-file as a query and writes one line of results per query")
+    print ("  -s  loads the index once and answers queries sent over localhost:port, or over stdin if port is -")
+    print ("  -k  only returns the top K results of every query")
+    print ("  -c  keeps up to cache-bytes of decoded posting lists in memory across queries (with -b or -s)")
+    print ("  -t  writes a JSON trace of every query (time of each stage, counters, candidates) to trace-file")
+    print ("  -P  profiles the run with cProfile and writes the stats to profile-file (main thread only)")
+    print ("  -e  sends the queries of a sharded index to the shard servers on these ports, in shard order,")
+    print ("      instead of starting a worker process for every shard")
+    print ("  -x  serves the requests of the shard workers of a sharded index for that shard")
 
-dictionary_file = postings_file = query_file = output_file_of_results = None
+dictionary_file = postings_file = query_file = output_file_of_results = port = top_k = cache_bytes = None
+trace_file = profile_file = shard = endpoints = None
+batch = False
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
+    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:s:bk:c:t:P:x:e:')
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -369,10 +1284,49 @@ for o, a in opts:
         query_file = a
     elif o == '-o':
         output_file_of_results = a
+    elif o == '-s':
+        port = a
+    elif o == '-b':
+        batch = True
+    elif o == '-k':
+        top_k = int(a)
+    elif o == '-c':
+        cache_bytes = int(a)
+    elif o == '-t':
+        trace_file = a
+    elif o == '-P':
+        profile_file = a
+    elif o == '-x':
+        shard = int(a)
+    elif o == '-e':
+        endpoints = a.split(',')
     else:
         assert False, "unhandled option"
-if dictionary_file == None or postings_file == None or query_file == None or output_file_of_results == None:
+if dictionary_file == None or postings_file == None or (top_k != None and top_k < 1) \
+    or (cache_bytes != None and cache_bytes < 0):
+    usage()
+    sys.exit(2)
+if port == None and (query_file == None or output_file_of_results == None):
+    usage()
+    sys.exit(2)
+if shard != None and (port == None or endpoints != None):
     usage()
     sys.exit(2)
 
-process_queries(dictionary_file, postings_file, query_file, output_file_of_results)
+if trace_file != None:
+    tracing.open_trace_file(trace_file)
+profiler = None
+if profile_file != None:
+    profiler = cProfile.Profile()
+    profiler.enable()
+if port != None:
+    serve_queries(dictionary_file, postings_file, port, top_k, cache_bytes, shard, endpoints)
+elif batch:
+    process_query_batch(dictionary_file, postings_file, query_file, output_file_of_results, top_k, cache_bytes,
+        endpoints)
+else:
+    process_queries(dictionary_file, postings_file, query_file, output_file_of_results, top_k, endpoints)
+if profiler != None:
+    profiler.disable()
+    profiler.dump_stats(profile_file)
+tracing.close_trace_file()
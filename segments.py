@@ -0,0 +1,69 @@
+# Contains the segment manifest of an index that is updated incrementally.
+#
+# An index built by index.py is a single segment: the dictionary file and the postings
+# file (with the lexicon and positions files next to them). Documents added later
+# are indexed into new segments, each a complete index of its own documents, stored
+# in <dictionary-file>.<n> and <postings-file>.<n>. Deleted documents, and older
+# copies of documents that are added again, are not removed from their segment but
+# recorded as tombstones.
+#
+# The manifest (<dictionary-file>.seg) lists the live segments and the tombstones of
+# each of them. It is replaced atomically, so a search that starts while the index is
+# updated sees either the old or the new list of segments. Without a manifest, the
+# index is a single segment without tombstones.
+
+import os
+import pickle
+
+SEGMENTS_MAGIC = b'LSEG'
+SEGMENTS_VERSION = 1
+SEGMENTS_SUFFIX = ".seg"
+
+# Returns the path of the manifest that belongs to the given dictionary file.
+def get_manifest_path(dictionary_file):
+    return dictionary_file + SEGMENTS_SUFFIX
+
+# Returns the dictionary file and the postings file of segment number.
+# Segment 0 is the index built by a full run of index.py.
+def get_segment_files(dictionary_file, postings_file, number):
+    if number == 0:
+        return dictionary_file, postings_file
+    return dictionary_file + "." + str(number), postings_file + "." + str(number)
+
+# Returns the manifest of the index: a dictionary holding the live segment numbers
+# (segments), the set of filenames of the deleted documents of every segment
+# (tombstones) and the number of the next segment (next_segment).
+def read_manifest(dictionary_file):
+    manifest_path = get_manifest_path(dictionary_file)
+    if not os.path.exists(manifest_path):
+        return {"segments": [0], "tombstones": {0: set()}, "next_segment": 1}
+    with open(manifest_path, mode="rb") as mf:
+        header = mf.read(len(SEGMENTS_MAGIC) + 1)
+        if header[:len(SEGMENTS_MAGIC)] != SEGMENTS_MAGIC:
+            raise ValueError("not a segment manifest, please rebuild the index")
+        if header[len(SEGMENTS_MAGIC)] != SEGMENTS_VERSION:
+            raise ValueError("segment manifest has version " + str(header[len(SEGMENTS_MAGIC)]) +
+                ", expected version " + str(SEGMENTS_VERSION) + ", please rebuild the index")
+        return pickle.load(mf)
+
+# Returns a value that changes whenever the manifest is replaced: its modification
+# time and inode number, or None if the index has no manifest.
+def get_manifest_version(dictionary_file):
+    try:
+        stat = os.stat(get_manifest_path(dictionary_file))
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_ino)
+
+# Writes the manifest to a temporary file and renames it over the old one.
+def write_manifest(dictionary_file, manifest):
+    manifest_path = get_manifest_path(dictionary_file)
+    with open(manifest_path + ".tmp", mode="wb") as mf:
+        mf.write(SEGMENTS_MAGIC + bytes([SEGMENTS_VERSION]))
+        pickle.dump(manifest, mf)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+# Removes the manifest, after a full rebuild of the index.
+def remove_manifest(dictionary_file):
+    if os.path.exists(get_manifest_path(dictionary_file)):
+        os.remove(get_manifest_path(dictionary_file))
@@ -0,0 +1,114 @@
+# Contains the layout of a sharded index, and the workers search.py sends the queries
+# of a sharded index to.
+#
+# index.py -n N splits the sorted collection into N shards of consecutive doc IDs.
+# Every shard is a complete index of its documents (document table, field store,
+# lexicon, postings, positions and impacts), stored in <dictionary-file>.shard<n> and
+# <postings-file>.shard<n>. The dictionary file itself holds the settings of the whole
+# index, with the number of shards in dictionary[SHARDS], and its lexicon holds the
+# document frequency of every term in the whole collection, without postings. The
+# shards are scored with that collection size and those document frequencies, so idf
+# is the same as in an index built without shards.
+#
+# search.py answers a query on a sharded index by sending it to a worker per shard,
+# which runs it on its shard only (see run_query_on_shards in search.py). A worker is
+# either a local process running search.py -x on its shard, started by search.py, or
+# a search.py -x server listening on a local port. Both answer one query per line,
+# with the filename and the exact score of every result, or with SHARD_ERROR and the
+# error if the query failed on the shard.
+
+import os
+import pickle
+import socket
+import subprocess
+import sys
+from utility import *
+
+SHARD_SUFFIX = ".shard"
+SHARD_ERROR = "error"
+
+# Returns the dictionary file and the postings file of shard number.
+def get_shard_files(dictionary_file, postings_file, number):
+    return dictionary_file + SHARD_SUFFIX + str(number), postings_file + SHARD_SUFFIX + str(number)
+
+# Splits the sorted collection into shard_count shards of consecutive documents, whose
+# sizes differ by at most one.
+def split_collection(collection, shard_count):
+    return [collection[len(collection) * number // shard_count:len(collection) * (number + 1) // shard_count]
+        for number in range(shard_count)]
+
+# Returns the number of shards of the index in dictionary_file, or 0 if it is not
+# sharded (or not built yet).
+def read_shard_count(dictionary_file):
+    if not os.path.exists(dictionary_file):
+        return 0
+    with open(dictionary_file, mode="rb") as df:
+        return pickle.load(df)[0].get(SHARDS, 0)
+
+# Returns the line a shard worker answers a query that failed with error with.
+def get_shard_error_line(error):
+    return SHARD_ERROR + "\t" + ' '.join(repr(error).split())
+
+# A worker that answers the queries of one shard, over a pipe to a local process or a
+# connection to a local port. start opens the pipe or the connection, and returns its
+# reader, writer, process and connection.
+class ShardWorker:
+    def __init__(self, start):
+        self.start = start
+        (self.reader, self.writer, self.process, self.connection) = start()
+
+    # Sends the query held by line. Every shard returns its top_k results, if top_k is
+    # given, so that the top_k results of the index are among them.
+    def send(self, line, top_k = None):
+        self.writer.write(str(top_k or 0) + "\t" + line.strip() + "\n")
+        self.writer.flush()
+
+    # Returns the (filename, score) tuples of the results of the query sent last.
+    # Raises RuntimeError if the query failed on the shard, and OSError or ValueError
+    # if the answer cannot be read, after which the worker must be restarted.
+    def receive(self):
+        answer = self.reader.readline()
+        if not answer:
+            raise ConnectionError("shard worker has exited")
+        if answer.startswith(SHARD_ERROR):
+            raise RuntimeError("query failed on shard: " + answer[len(SHARD_ERROR):].strip())
+        values = answer.split()
+        return [(int(values[i]), float(values[i + 1])) for i in range(0, len(values), 2)]
+
+    # Drops the pipe or connection, with any answers left unread on it, and opens a
+    # new one.
+    def restart(self):
+        if self.process is not None:
+            self.process.kill()
+        self.close()
+        (self.reader, self.writer, self.process, self.connection) = self.start()
+
+    def close(self):
+        for stream in (self.writer, self.reader):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        if self.process is not None:
+            self.process.wait()
+        if self.connection is not None:
+            self.connection.close()
+
+# Starts a local process that answers the queries of shard number of the index.
+def start_shard_process(dictionary_file, postings_file, number, cache_bytes = None):
+    search_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "search.py")
+    command = [sys.executable, search_script, "-d", dictionary_file, "-p", postings_file, "-s", "-", "-x", str(number)]
+    if cache_bytes is not None:
+        command += ["-c", str(cache_bytes)]
+    def start():
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, encoding="utf8")
+        return (process.stdout, process.stdin, process, None)
+    return ShardWorker(start)
+
+# Connects to the search.py -x server of a shard on localhost:port.
+def connect_shard(port):
+    def start():
+        connection = socket.create_connection(("127.0.0.1", int(port)))
+        return (connection.makefile("r", encoding="utf8"), connection.makefile("w", encoding="utf8"), None,
+            connection)
+    return ShardWorker(start)
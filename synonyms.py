@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# Contains the synonym table used for query expansion.
+#
+# Looking up synonyms in WordNet loads all of WordNet on the first query. Instead, the
+# synonyms of every word of the collection, and of every WordNet collocation made of
+# words of the collection, are looked up once after indexing and written to a synonym
+# table next to the dictionary file (<dictionary-file>.syn). The table maps a word (or
+# a collocation joined by underscores) to its stemmed word synonyms and its phrase
+# synonyms, already parsed into phrasal queries, exactly as get_wordnet_synonyms
+# returns them.
+#
+# The file starts with SYNONYMS_MAGIC and one byte holding SYNONYMS_VERSION, followed
+# by the pickled table.
+
+import getopt
+import os
+import pickle
+import sys
+from nltk.corpus import wordnet as wn
+from queryParser import get_new_phrasal_query
+from utility import *
+
+SYNONYMS_MAGIC = b'LSES'
+SYNONYMS_VERSION = 1
+SYNONYMS_SUFFIX = ".syn"
+
+no_synonyms = ([], [])
+
+# Returns the path of the synonym table that belongs to the given dictionary file.
+def get_synonyms_path(dictionary_file):
+    return dictionary_file + SYNONYMS_SUFFIX
+
+# Returns the stemmed word synonyms and the phrase synonyms (as phrasal queries) of
+# the word in WordNet.
+def get_wordnet_synonyms(word):
+    word_synonyms = []
+    phrase_synonym = []
+    syn_set = wn.synsets(word)
+    for syn in syn_set:
+        for lemma in syn.lemma_names():
+            if lemma in word_synonyms or lemma == word:
+                continue
+            if underscore not in lemma:
+                lemma = stem_term(lemma)
+                if lemma == empty_string:
+                    continue
+                word_synonyms.append(lemma)
+            else:
+                words = lemma.split(underscore)
+                phrase_synonym.append(get_new_phrasal_query(words))
+    return word_synonyms, phrase_synonym
+
+# Looks up synonyms in a synonym table file. Words that are not in the table have no
+# synonyms.
+class SynonymTable:
+    def __init__(self, synonyms_path):
+        with open(synonyms_path, mode="rb") as sf:
+            header = sf.read(len(SYNONYMS_MAGIC) + 1)
+            if header[:len(SYNONYMS_MAGIC)] != SYNONYMS_MAGIC:
+                raise ValueError("not a synonym table, please rebuild it")
+            if header[len(SYNONYMS_MAGIC)] != SYNONYMS_VERSION:
+                raise ValueError("synonym table has version " + str(header[len(SYNONYMS_MAGIC)]) +
+                    ", expected version " + str(SYNONYMS_VERSION) + ", please rebuild it")
+            self.table = pickle.load(sf)
+
+    # WordNet ignores the case of words, and so does the table.
+    def get(self, word):
+        return self.table.get(word.lower(), no_synonyms)
+
+# Returns the casefolded words of every document in file_path, split by the tokenizer
+# the index was built with.
+def get_collection_words(file_path, dictionary_file):
+    from index import parse_xml
+    with open(dictionary_file, mode="rb") as df:
+        dictionary = pickle.load(df)[0]
+    set_tokenizer(dictionary.get(TOKENIZER, NLTK_TOKENIZER))
+    words = set()
+    for filename in os.listdir(file_path):
+        if filename == ".DS_Store":
+            continue
+        (content, court, tag) = parse_xml(file_path, int(filename[:-len(xml)]))
+        words.update(word.casefold() for word in tokenize(content))
+    return words
+
+# Builds the synonym table of the collection in file_path and writes it next to
+# dictionary_file.
+def build_synonym_table(file_path, dictionary_file):
+    print('building synonym table...')
+    words = get_collection_words(file_path, dictionary_file)
+    keys = [word for word in words if not check_stopwords(word)]
+    for lemma in wn.all_lemma_names():
+        if underscore in lemma and all(word in words for word in lemma.split(underscore)):
+            keys.append(lemma)
+
+    table = dict()
+    for key in keys:
+        synonyms = get_wordnet_synonyms(key)
+        if synonyms != no_synonyms:
+            table[key] = synonyms
+    with open(get_synonyms_path(dictionary_file), mode="wb") as sf:
+        sf.write(SYNONYMS_MAGIC + bytes([SYNONYMS_VERSION]))
+        pickle.dump(table, sf)
+    print(str(len(table)) + ' words with synonyms')
+    print('...synonym table is done building')
+
+def usage():
+    print ("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file")
+
+if __name__ == "__main__":
+    directory_of_documents = dictionary_file = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == '-i':
+            directory_of_documents = a
+        elif o == '-d':
+            dictionary_file = a
+        else:
+            assert False, "unhandled option"
+    if directory_of_documents == None or dictionary_file == None:
+        usage()
+        sys.exit(2)
+
+    build_synonym_table(directory_of_documents, dictionary_file)
@@ -0,0 +1,84 @@
+# Checks that an index updated with segments (index.py -a, -r and -c) answers queries
+# exactly like an index built from scratch from the same live documents.
+#
+# Run with `python -m pytest tests` from the top directory. The corpus is generated by
+# benchmark.py, and index.py and search.py are run as scripts.
+
+import os
+import shutil
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+sys.path.insert(0, top)
+
+import benchmark
+from utility import *
+
+document_count = 400
+query_count = 300
+
+# Runs a script of the top directory in work_directory, which holds its run files.
+def run_script(script, arguments, work_directory):
+    subprocess.run([sys.executable, os.path.join(top, script)] + arguments, cwd=work_directory, check=True,
+        stdout=subprocess.DEVNULL)
+
+# Copies the documents with the given doc IDs into a new directory.
+def copy_documents(source, destination, doc_ids):
+    os.makedirs(destination)
+    for doc_id in doc_ids:
+        shutil.copy(os.path.join(source, str(doc_id) + xml), destination)
+    return os.path.join(destination, empty_string)
+
+# Returns the lines of results of the queries on the index in work_directory.
+def search(work_directory, query_file):
+    (dictionary_file, postings_file) = benchmark.get_index_files(work_directory)
+    output_file = os.path.join(work_directory, "results.txt")
+    run_script("search.py", ["-d", dictionary_file, "-p", postings_file, "-q", query_file, "-o", output_file, "-b"],
+        work_directory)
+    with open(output_file, encoding="utf8") as of:
+        return of.read().splitlines()
+
+# Builds an index from a base and two added segments, replaces and deletes some
+# documents, compacts the added segments, and compares its results with the ones of
+# an index built from the live documents.
+def check_compaction(tmp_path, index_options):
+    corpus = str(tmp_path / "corpus")
+    doc_ids = benchmark.generate_corpus(corpus, document_count)
+    base = doc_ids[:250]
+    # The first added segment replaces some documents of the base.
+    added = [doc_ids[250:330] + base[:20], doc_ids[330:]]
+    deleted = base[40:60] + doc_ids[260:270] + doc_ids[340:345]
+    live = sorted(set(doc_ids) - set(deleted))
+
+    updated = str(tmp_path / "updated")
+    os.makedirs(updated)
+    (dictionary_file, postings_file) = benchmark.get_index_files(updated)
+    run_script("index.py", ["-i", copy_documents(corpus, str(tmp_path / "base"), base), "-d", dictionary_file,
+        "-p", postings_file] + index_options, updated)
+    for (number, added_doc_ids) in enumerate(added):
+        run_script("index.py", ["-i", copy_documents(corpus, str(tmp_path / ("added" + str(number))), added_doc_ids),
+            "-d", dictionary_file, "-p", postings_file, "-a"], updated)
+    deleted_file = str(tmp_path / "deleted.txt")
+    with open(deleted_file, mode="w") as df:
+        df.write("\n".join(map(str, deleted)) + "\n")
+    run_script("index.py", ["-d", dictionary_file, "-p", postings_file, "-r", deleted_file], updated)
+
+    fresh = str(tmp_path / "fresh")
+    benchmark.run_indexing(copy_documents(corpus, str(tmp_path / "live"), live), fresh, index_options)
+    query_file = str(tmp_path / "queries.txt")
+    with open(query_file, mode="w", encoding="utf8") as qf:
+        for (kind, line) in benchmark.generate_queries(corpus, query_count):
+            qf.write(line + "\n")
+    expected = search(fresh, query_file)
+    assert search(updated, query_file) == expected
+
+    run_script("index.py", ["-d", dictionary_file, "-p", postings_file, "-c"], updated)
+    assert search(updated, query_file) == expected
+
+def test_compaction(tmp_path):
+    check_compaction(tmp_path, [])
+
+def test_compaction_with_biwords(tmp_path):
+    check_compaction(tmp_path, ["-b"])
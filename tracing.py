@@ -0,0 +1,97 @@
+# Contains the per-query tracing of search.py.
+#
+# When tracing is enabled (search.py -t trace-file), every query gets a QueryTrace that
+# records the wall time of each stage of the query, counters such as the posting lists
+# and bytes decoded, the number of candidates left after each intersection, and the
+# terms of the expansion rounds. When the query is answered, its trace is written to
+# the trace file as one line of JSON.
+#
+# The trace of a query is kept in a thread-local variable, so the query server can
+# trace the queries of several connections at once, and the code that records into
+# it does not need to pass it around. When tracing is disabled, every recording
+# function returns right after checking `enabled`.
+
+import json
+import threading
+import time
+
+enabled = False
+trace_file = None
+trace_lock = threading.Lock()
+local = threading.local()
+
+# The measurements of one query.
+class QueryTrace:
+    def __init__(self, query):
+        self.query = query
+        self.start = self.last_mark = time.perf_counter()
+        self.stages = dict()
+        self.counters = dict()
+        self.candidates = []
+        self.expansion_terms = []
+
+    # Returns the trace as a dictionary of JSON values, given the number of results.
+    def to_json(self, result_count):
+        return {"query": self.query, "total_ms": 1000 * (time.perf_counter() - self.start),
+            "stages_ms": {name: 1000 * seconds for (name, seconds) in self.stages.items()},
+            "counters": self.counters, "candidates": self.candidates,
+            "expansion_terms": self.expansion_terms, "results": result_count}
+
+# Enables tracing, writing the traces to the file at trace_path.
+def open_trace_file(trace_path):
+    global enabled, trace_file
+    trace_file = open(trace_path, mode="w", encoding="utf8")
+    enabled = True
+
+def close_trace_file():
+    global enabled, trace_file
+    enabled = False
+    if trace_file is not None:
+        trace_file.close()
+        trace_file = None
+
+# Starts the trace of a query in the current thread.
+def start_trace(query):
+    if not enabled:
+        return
+    local.trace = QueryTrace(query.strip())
+
+# Records the time since the previous stage (or the start of the query) as the time
+# of stage name. A stage that runs more than once in a query, for example once per
+# segment, is charged the sum of its times.
+def end_stage(name):
+    if not enabled or getattr(local, "trace", None) is None:
+        return
+    trace = local.trace
+    now = time.perf_counter()
+    trace.stages[name] = trace.stages.get(name, 0) + now - trace.last_mark
+    trace.last_mark = now
+
+# Adds amount to the counter name.
+def count(name, amount = 1):
+    if not enabled or getattr(local, "trace", None) is None:
+        return
+    counters = local.trace.counters
+    counters[name] = counters.get(name, 0) + amount
+
+# Records the number of candidates left after a step of the query.
+def add_candidates(step, candidate_count):
+    if not enabled or getattr(local, "trace", None) is None:
+        return
+    local.trace.candidates.append({"step": step, "candidates": candidate_count})
+
+# Records the terms of an expansion round that are in the index, and its weight.
+def add_expansion_terms(terms, weight, remove_incomplete):
+    if not enabled or getattr(local, "trace", None) is None:
+        return
+    local.trace.expansion_terms.append({"terms": terms, "weight": weight, "phrase": remove_incomplete})
+
+# Finishes the trace of the query in the current thread and writes it to the trace file.
+def finish_trace(result_count):
+    if not enabled or getattr(local, "trace", None) is None:
+        return
+    line = json.dumps(local.trace.to_json(result_count), sort_keys=True)
+    local.trace = None
+    with trace_lock:
+        trace_file.write(line + "\n")
+        trace_file.flush()
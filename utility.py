@@ -1,7 +1,9 @@
-from nltk import PorterStemmer
+from nltk import PorterStemmer, word_tokenize
 from nltk.corpus import stopwords
+from functools import lru_cache
 import string
 import math
+import re
 
 # Contains some constant variables and term-normalization function.
 
@@ -17,6 +19,16 @@ JURISDICTION = 'JURISDICTION'
 COURT = 'COURT'
 LANGUAGE = 'english'
 TAG = 'TAG'
+TOKENIZER = 'TOKENIZER'
+SYNONYMS = 'SYNONYMS'
+SEGMENTS = 'SEGMENTS'
+TOMBSTONES = 'TOMBSTONES'
+IMPACTS = 'IMPACTS'
+FIELDS = 'FIELDS'
+FILENAMES = 'FILENAMES'
+SHARDS = 'SHARDS'
+GLOBAL_LEXICON = 'GLOBAL_LEXICON'
+BIWORDS = 'BIWORDS'
 PHRASE = 'PHRASE'
 WORD = 'WORD'
 underscore = "_"
@@ -27,13 +39,63 @@ POSITION = 'position'
 
 synonyms_phrase_weight = 0.08
 synonyms_word_weight = 0.03
+# The score of a document is multiplied by these boosts for every pair of query phrases
+# within 20 words (a sentence) or within 100 words (a paragraph) of each other.
+sentence_boost = 1.5
+paragraph_boost = 1.2
 courts_score = {"SGHC": 0.008, "SGCA": 0.012, "SG": 0.006, "CA": 0.005}
 tag_score = 0.01
+# Posting lists of a query that are less than this many bytes apart on disk are
+# prefetched as one read.
+prefetch_gap = 1 << 16
+# Estimated memory of one decoded doc ID (a list slot and an int object), used to
+# charge posting lists to the postings cache.
+decoded_doc_id_bytes = 36
+# Separates the terms of a biword. No term contains it.
+biword_separator = ' '
+
+# Tokenizers that documents and queries can be split with. The index stores the one it
+# was built with, and search.py splits queries with the same one.
+NLTK_TOKENIZER = 'nltk'
+REGEX_TOKENIZER = 'regex'
+tokenizer = NLTK_TOKENIZER
+
+# Matches the tokens word_tokenize gives for ordinary text, without sentence splitting:
+# clitics ("do" "n't", "court" "'s") are split off, words keep their inner hyphens,
+# periods, slashes and apostrophes (and commas between digits), a trailing period is
+# kept only by abbreviations such as "u.s." and initials such as "v.", and any other
+# character is a token.
+regex_tokens = re.compile(r"""
+    \w+?(?=n't\b)
+  | (?i:n't|'(?:s|m|d|re|ve|ll))\b
+  | \b[^\W\d_]\.(?=\s)
+  | \w+(?:[-./:]\w+|'(?!(?i:s|m|d|re|ve|ll)\b)\w+|(?<=\d),(?=\d)\w+)*(?:(?<=\.\w)\.)?
+  | --|\.\.\.|``|''|\S
+""", re.VERBOSE)
+
+# Maximum number of words whose normalized form is cached.
+normalize_cache_size = 1 << 18
 
 stemmer = PorterStemmer()
-stopwords = stopwords.words(LANGUAGE)
+stopwords = frozenset(stopwords.words(LANGUAGE))
+
+# Selects the tokenizer used by tokenize.
+def set_tokenizer(name):
+    global tokenizer
+    if name not in (NLTK_TOKENIZER, REGEX_TOKENIZER):
+        raise ValueError("unknown tokenizer " + str(name))
+    tokenizer = name
+
+# Splits the given text into words with the selected tokenizer.
+def tokenize(text):
+    if tokenizer == REGEX_TOKENIZER:
+        return regex_tokens.findall(text)
+    return word_tokenize(text)
 
 # Normalizes the given term.
+# The vocabulary is much smaller than the number of words in the collection, so the
+# results are cached.
+@lru_cache(maxsize = normalize_cache_size)
 def normalize(term):
     term = term.casefold()
     if check_stopwords(term):
@@ -43,12 +105,23 @@ def normalize(term):
 def check_stopwords(term):
     return term in stopwords
 
+@lru_cache(maxsize = normalize_cache_size)
 def stem_term(term):
     term = stemmer.stem(term)
     if term in string.punctuation or term in punctuations:
         return empty_string
     return term
 
+# Returns the biword of two different terms: both terms in sorted order, so a pair of
+# adjacent terms has the same biword in either order.
+def get_biword(term1, term2):
+    if term1 < term2:
+        return term1 + biword_separator + term2
+    return term2 + biword_separator + term1
+
+def is_biword(term):
+    return biword_separator in term
+
 # Calculates log_tf.
 def calculate_log_tf(tf):
     return 1 + math.log(tf, 10)